@@ -1,6 +1,8 @@
 import secrets
 import time
 import asyncio
+import base64
+import json
 
 from fastapi import HTTPException
 from pymongo.errors import DuplicateKeyError
@@ -8,12 +10,28 @@ from pymongo import DESCENDING
 
 from app.validation import AccountValidator
 from app.cryptography import PasswordManager
-from app.utils import now
+from app.utils import now, combine
 
 
 class AccountManager:
     """The manager manages creating, updating and deleting user accounts."""
 
+    # maximum number of surveys that are deleted concurrently
+    CONCURRENCY = 16
+
+    # configuration fields that can be selected when listing configurations
+    FIELDS = {
+        'survey_name',
+        'title',
+        'description',
+        'start',
+        'end',
+        'draft',
+        'authentication',
+        'limit',
+        'fields',
+    }
+
     def __init__(self, database, letterbox, token_manager, survey_manager):
         """Initialize an user manager instance."""
         self.database = database
@@ -116,23 +134,29 @@ class AccountManager:
     async def update(self, username, account_data, access_token):
         """Update existing user account data in the database."""
         self.token_manager.authorize(username, access_token)
-        self._update(username, account_data)
+        await self._update(username, account_data)
 
     async def delete(self, username, access_token):
         """Delete the user including all her surveys from the database."""
         self.token_manager.authorize(username, access_token)
-        self._delete(username)
+        await self._delete(username)
 
     async def fetch_configurations(
             self,
             username,
-            skip,
+            after,
             limit,
+            fields,
             access_token,
         ):
-        """Return a list of the user's survey configurations."""
+        """Return a page of the user's survey configurations."""
+        self.token_manager.authorize(username, access_token)
+        return await self._fetch_configurations(username, after, limit, fields)
+
+    async def fetch_summaries(self, username, access_token):
+        """Return an overview of all the user's surveys."""
         self.token_manager.authorize(username, access_token)
-        return await self._fetch_configurations(username, skip, limit)
+        return await self._fetch_summaries(username)
 
     async def _fetch(self, username):
         """Return the account data corresponding to given user name."""
@@ -174,43 +198,181 @@ class AccountManager:
 
         if not self.validator.validate(account_data):
             raise HTTPException(400, 'invalid account data')
+        if account_data['username'] != username:
+            raise HTTPException(400, 'username cannot be changed')
 
-        # TODO cannot do a full replace, think password hash!
+        # only set the updated fields, the password hash etc. stay untouched
 
-        result = await self.database['accounts'].replace_one(
-            filter={'_id': username},
-            replacement=account_data,
-        )
+        try:
+            result = await self.database['accounts'].update_one(
+                filter={'_id': username},
+                update={
+                    '$set': {'email_address': account_data['email_address']},
+                },
+            )
+        except DuplicateKeyError:
+            raise HTTPException(400, 'email address already taken')
         if result.matched_count == 0:
             raise HTTPException(404, 'account not found')
 
     async def _delete(self, username):
-        """Delete the user including all her surveys from the database."""
-        await self.database['accounts'].delete_one({'_id': username})
+        """Delete the user including all her surveys from the database.
+
+        The surveys are deleted concurrently. The number of surveys deleted at
+        the same time is bounded, such that deleting an account with hundreds
+        of surveys does not exhaust the database connection pool for the
+        requests of all other users.
+
+        """
         cursor = self.database['configurations'].find(
             filter={'username': username},
             projection={'_id': False, 'survey_name': True},
         )
-        survey_names = [
-            configuration['survey_name']
+        _, configurations = await asyncio.gather(
+            self.database['accounts'].delete_one({'_id': username}),
+            cursor.to_list(None),
+        )
+        semaphore = asyncio.Semaphore(self.CONCURRENCY)
+
+        async def _delete_survey(survey_name):
+            """Delete a single survey once the semaphore admits it."""
+            async with semaphore:
+                await self.survey_manager._delete(username, survey_name)
+
+        await asyncio.gather(*[
+            _delete_survey(configuration['survey_name'])
             for configuration
-            in await cursor.to_list(None)
+            in configurations
+        ])
+
+    @staticmethod
+    def _encode_cursor(configuration):
+        """Build opaque pagination cursor pointing after the configuration."""
+        key = [configuration['start'], configuration['survey_name']]
+        return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        """Return the (start, survey_name) key encoded in the given cursor."""
+        try:
+            start, survey_name = json.loads(base64.urlsafe_b64decode(cursor))
+        except (ValueError, TypeError):
+            raise HTTPException(400, 'invalid cursor')
+        if type(start) is not int or type(survey_name) is not str:
+            raise HTTPException(400, 'invalid cursor')
+        return start, survey_name
+
+    async def _fetch_configurations(self, username, after, limit, fields):
+        """Return a page of the user's survey configurations.
+
+        The configurations are sorted by their start date, ties are broken by
+        the survey name. Instead of skipping over the previous pages, we seek
+        directly to the key of the last configuration of the previous page,
+        which is encoded in the `after` cursor. Together with the compound
+        (username, start, survey_name) index this makes fetching deep pages
+        as cheap as fetching the first one.
+
+        """
+        expression = {'username': username}
+        if after is not None:
+            start, survey_name = self._decode_cursor(after)
+            expression['$or'] = [
+                {'start': {'$lt': start}},
+                {'start': start, 'survey_name': {'$lt': survey_name}},
+            ]
+        if fields is None:
+            fields = self.FIELDS
+        if not set(fields) <= self.FIELDS:
+            raise HTTPException(400, 'invalid fields')
+        projection = {field: True for field in fields}
+        projection.update({'_id': False, 'start': True, 'survey_name': True})
+        cursor = self.database['configurations'].find(
+            filter=expression,
+            projection=projection,
+            sort=[('start', DESCENDING), ('survey_name', DESCENDING)],
+            limit=limit,
+        )
+        configurations = await cursor.to_list(None)
+        after = (
+            self._encode_cursor(configurations[-1])
+            if len(configurations) == limit
+            else None
+        )
+        for configuration in configurations:
+            for field in ['start', 'survey_name']:
+                if field not in fields:
+                    del configuration[field]
+        return {'configurations': configurations, 'after': after}
+
+    async def _count_submissions(self, configuration):
+        """Return the submitted and verified submission counts of a survey.
+
+        The counts are estimates taken from the collection metadata instead
+        of counting the documents, which is why they are cheap but only
+        approximate, e.g. they can be off after an unclean shutdown. Email
+        surveys keep every submission in the submissions collection, even
+        once it is verified, so the submitted count includes the verified
+        ones as well as repeated submissions of the same email address.
+        Surveys not verifying email addresses accept submissions directly,
+        which means that all of their submissions count as verified.
+
+        """
+        survey_id = combine(
+            configuration['username'],
+            configuration['survey_name'],
+        )
+        submissions = self.database[f'surveys.{survey_id}.submissions']
+        if configuration['authentication'] != 'email':
+            count = await submissions.estimated_document_count()
+            return count, count
+        verified_submissions = self.database[
+            f'surveys.{survey_id}.verified-submissions'
         ]
-        for survey_name in survey_names:
-            await self.survey_manager._delete(username, survey_name)
+        return await asyncio.gather(
+            submissions.estimated_document_count(),
+            verified_submissions.estimated_document_count(),
+        )
 
-    async def _fetch_configurations(self, username, skip, limit):
-        """Return a list of the user's survey configurations."""
+    async def _fetch_summaries(self, username):
+        """Return an overview of all the user's surveys.
+
+        The overview contains the survey metadata, the survey status as well
+        as the approximate current submission counts. The counts of all
+        surveys are fetched concurrently, such that the whole overview takes
+        only two sequential database round trips.
+
+        """
         cursor = self.database['configurations'].find(
             filter={'username': username},
             projection={
                 '_id': False,
-                'username': False,
-                'survey_name': False,
+                'username': True,
+                'survey_name': True,
+                'title': True,
+                'start': True,
+                'end': True,
+                'draft': True,
+                'authentication': True,
             },
-            sort=[('start', DESCENDING)],
-            skip=skip,
-            limit=limit,
+            sort=[('start', DESCENDING), ('survey_name', DESCENDING)],
         )
         configurations = await cursor.to_list(None)
-        return configurations
+        countss = await asyncio.gather(*[
+            self._count_submissions(configuration)
+            for configuration
+            in configurations
+        ])
+        timestamp = now()
+        summaries = []
+        for configuration, counts in zip(configurations, countss):
+            del configuration['username']
+            configuration['status'] = (
+                'scheduled'
+                if timestamp < configuration['start']
+                else 'open'
+                if timestamp < configuration['end']
+                else 'closed'
+            )
+            configuration['submitted'], configuration['verified'] = counts
+            summaries.append(configuration)
+        return summaries
@@ -0,0 +1,186 @@
+import re
+import time
+import asyncio
+import contextlib
+
+from fastapi import HTTPException
+from starlette.responses import JSONResponse
+
+
+class AdmissionController:
+    """Limits the number of concurrently processed requests per survey.
+
+    A single popular survey can otherwise occupy the whole event loop and
+    database connection pool, slowing down the requests of all other
+    surveys. Every survey may process at most `concurrency` requests at a
+    time, further requests wait in a queue of at most `queue` requests.
+    Requests beyond that are shed immediately with a 503 response telling
+    the client when to retry, which is cheaper for everyone than letting
+    them time out.
+
+    """
+
+    def __init__(self, concurrency, queue, retry_after=1):
+        """Initialize an admission controller instance."""
+        self.concurrency = concurrency
+        self.queue = queue
+        self.retry_after = retry_after
+        self.semaphores = {}
+        self.active = {}
+        self.waiting = {}
+        self.admitted = 0
+        self.rejected = 0
+
+    @contextlib.asynccontextmanager
+    async def admit(self, key):
+        """Process the enclosed block once a slot for the key is free."""
+        semaphore = self.semaphores.get(key)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.concurrency)
+            self.semaphores[key] = semaphore
+        if semaphore.locked():
+            if self.waiting.get(key, 0) >= self.queue:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail='survey is overloaded',
+                    headers={'Retry-After': str(self.retry_after)},
+                )
+            self.waiting[key] = self.waiting.get(key, 0) + 1
+            try:
+                await semaphore.acquire()
+            finally:
+                self.waiting[key] -= 1
+                if self.waiting[key] == 0:
+                    del self.waiting[key]
+        else:
+            await semaphore.acquire()
+        self.active[key] = self.active.get(key, 0) + 1
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            semaphore.release()
+            self.active[key] -= 1
+            if self.active[key] == 0:
+                del self.active[key]
+                if key not in self.waiting:
+                    del self.semaphores[key]
+
+    @property
+    def statistics(self):
+        """Return the configured limits and the current load."""
+        return {
+            'concurrency': self.concurrency,
+            'queue': self.queue,
+            'active': sum(self.active.values()),
+            'waiting': sum(self.waiting.values()),
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+        }
+
+
+class LoadShedder:
+    """Rejects requests early when the whole server is overloaded.
+
+    Under a load spike, requests queue up in the event loop and latency
+    grows until clients time out, at which point the server does a lot of
+    work for no one. The shedder measures the lag of the event loop, i.e.
+    how late a regularly scheduled callback runs, and counts the requests
+    in flight. When either exceeds its threshold, requests are rejected
+    with a 503 response, starting with the least important ones: fetching
+    results and listing surveys are shed at the threshold, other requests
+    at twice and submissions only at four times the threshold.
+
+    """
+
+    # seconds between two measurements of the event loop lag
+    INTERVAL = 0.1
+    # weight of the newest measurement in the moving average of the lag
+    SMOOTHING = 0.25
+    # overload factors at which requests of the priorities are shed
+    FACTORS = {'low': 1, 'normal': 2, 'high': 4}
+    # method and path patterns of the low and high priority routes
+    PRIORITIES = [
+        ('low', re.compile(r'GET /users/[^/]+/surveys/[^/]+/results(/.*)?')),
+        ('low', re.compile(r'GET /users/[^/]+/(surveys|summaries)')),
+        ('high', re.compile(r'POST /users/[^/]+/surveys/[^/]+/submissions')),
+        ('high', re.compile(
+            r'GET /users/[^/]+/surveys/[^/]+/verification/[^/]+'
+        )),
+    ]
+
+    def __init__(self, lag, inflight, retry_after=1):
+        """Initialize a load shedder with lag and in-flight thresholds."""
+        self.threshold_lag = lag
+        self.threshold_inflight = inflight
+        self.retry_after = retry_after
+        self.lag = 0
+        self.inflight = 0
+        self.shed = {priority: 0 for priority in self.FACTORS.keys()}
+        self.task = None
+
+    def start(self):
+        """Start measuring the event loop lag in the background."""
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop measuring the event loop lag."""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        """Regularly measure how late the event loop wakes us up."""
+        while True:
+            timestamp = time.perf_counter()
+            await asyncio.sleep(self.INTERVAL)
+            lag = max(time.perf_counter() - timestamp - self.INTERVAL, 0)
+            self.lag += self.SMOOTHING * (lag - self.lag)
+
+    def _prioritize(self, method, path):
+        """Return the priority of the route matching method and path."""
+        route = f'{method} {path}'
+        for priority, pattern in self.PRIORITIES:
+            if pattern.fullmatch(route):
+                return priority
+        return 'normal'
+
+    def overloaded(self, priority):
+        """Check if requests of the given priority are to be shed."""
+        factor = self.FACTORS[priority]
+        return (
+            self.lag > factor * self.threshold_lag
+            or self.inflight >= factor * self.threshold_inflight
+        )
+
+    async def dispatch(self, request, call_next):
+        """Process the request unless the server is overloaded."""
+        priority = self._prioritize(request.method, request.url.path)
+        if self.overloaded(priority):
+            self.shed[priority] += 1
+            return JSONResponse(
+                status_code=503,
+                content={'detail': 'server is overloaded'},
+                headers={'Retry-After': str(self.retry_after)},
+            )
+        self.inflight += 1
+        try:
+            return await call_next(request)
+        finally:
+            self.inflight -= 1
+
+    @property
+    def statistics(self):
+        """Return the configured thresholds and the current load."""
+        return {
+            'lag': self.lag,
+            'max_lag': self.threshold_lag,
+            'inflight': self.inflight,
+            'max_inflight': self.threshold_inflight,
+            'shed': dict(self.shed),
+        }
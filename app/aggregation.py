@@ -1,22 +1,165 @@
-from app.utils import combine
+import os
+import re
+import asyncio
+import unicodedata
+
+import orjson
+import numpy
+
+from cachetools import LRUCache
+from pymongo import ASCENDING, ReturnDocument
+
+from app.sketches import SpaceSaving, HyperLogLog
+from app.utils import combine, fingerprint
+
+
+# number of concurrently aggregated partitions of the submissions
+AGGREGATION_PARTITIONS = int(os.getenv('AGGREGATION_PARTITIONS', '1'))
+# maximum number of submissions that are aggregated locally
+VECTORIZATION_THRESHOLD = int(os.getenv('VECTORIZATION_THRESHOLD', '100000'))
+# compiled pipeline parts of recently used field structures
+PIPELINES = LRUCache(maxsize=1024)
+
+
+class TextSummary:
+    """Summarizes the answers to a text field in bounded memory.
+
+    We count the normalized terms of the answers with a Space-Saving sketch,
+    such that the memory use does not grow with the number of submissions,
+    and keep some running statistics about the answer lengths.
+
+    """
+
+    # number of most frequent terms that are part of the results
+    TERMS = 10
+    # number of terms that are counted at the same time
+    CAPACITY = 1000
+    # regular expression matching single terms, e.g. "ice" or "don't"
+    REGEX = re.compile(r"\w+(?:'\w+)*")
+
+    def __init__(self):
+        """Initialize an empty text summary."""
+        self.sketch = SpaceSaving(self.CAPACITY)
+        self.count = 0
+        self.total = 0
+        self.min_length = None
+        self.max_length = None
+
+    def add(self, value):
+        """Add the given text answer to the summary."""
+        length = len(value)
+        self.count += 1
+        self.total += length
+        if self.min_length is None or length < self.min_length:
+            self.min_length = length
+        if self.max_length is None or length > self.max_length:
+            self.max_length = length
+        value = unicodedata.normalize('NFKC', value).casefold()
+        for term in self.REGEX.findall(value):
+            self.sketch.add(term)
+
+    def merge(self, other):
+        """Merge the summary of another partition into this one."""
+        self.count += other.count
+        self.total += other.total
+        for attribute, function in [('min_length', min), ('max_length', max)]:
+            values = [
+                value
+                for value
+                in [getattr(self, attribute), getattr(other, attribute)]
+                if value is not None
+            ]
+            setattr(self, attribute, function(values) if values else None)
+        self.sketch.merge(other.sketch)
+
+    def result(self):
+        """Return the summary in the results format."""
+        return {
+            'count': self.count,
+            'terms': [
+                {'term': term, 'count': count}
+                for term, count
+                in self.sketch.top(self.TERMS)
+            ],
+            'min_length': self.min_length,
+            'max_length': self.max_length,
+            'mean_length': (
+                round(self.total / self.count, 2)
+                if self.count
+                else None
+            ),
+        }
+
+
+class EmailSummary:
+    """Estimates the number of distinct answers to an email field.
+
+    Collecting the distinct addresses e.g. via `$addToSet` would quickly
+    exceed the memory and document size limits for large surveys. We thus
+    count them approximately with a HyperLogLog sketch, whose registers are
+    stored alongside the results, such that they can later be merged with
+    the sketches of further submissions.
+
+    """
+
+    def __init__(self):
+        """Initialize an empty email summary."""
+        self.sketch = HyperLogLog()
+        self.count = 0
+
+    def add(self, value):
+        """Add the given email address to the summary."""
+        self.count += 1
+        self.sketch.add(value.strip().casefold())
+
+    def merge(self, other):
+        """Merge the summary of another partition into this one."""
+        self.count += other.count
+        self.sketch.merge(other.sketch)
+
+    def result(self):
+        """Return the summary in the results format."""
+        return {'count': self.count, 'distinct': self.sketch.estimate()}
 
 
 class Alligator:
     """Does it aggregate ... or does it alligate ... ?"""
 
-    def __init__(self, configuration, database):
-        """Initialize alligator with some pipeline parts already defined."""
+    # number of sampled submissions per partition to find the boundaries
+    SAMPLES = 100
+    # number of submissions that are reduced at once by the local engine
+    BATCH_SIZE = 10000
+
+    def __init__(
+            self,
+            configuration,
+            database,
+            partitions=AGGREGATION_PARTITIONS,
+            threshold=VECTORIZATION_THRESHOLD,
+            cache=None,
+        ):
+        """Initialize alligator with some pipeline parts already defined.
+
+        The cache maps survey identifiers to their versioned results. It is
+        usually a bounded cache shared by all surveys of the worker, such that
+        the results outlive the survey objects in the survey cache.
+
+        """
         self.configuration = configuration
+        self.partitions = partitions
+        self.threshold = threshold
+        self.cache = cache if cache is not None else {}
         self.survey_id = combine(
             configuration['username'],
             configuration['survey_name'],
         )
         self.collection = (
-            database[f'surveys.{self.survey_id}.submissions']
-            if self.configuration['authentication'] == 'open'
-            else database[f'surveys.{self.survey_id}.verified-submissions']
+            database[f'surveys.{self.survey_id}.verified-submissions']
+            if self.configuration['authentication'] == 'email'
+            else database[f'surveys.{self.survey_id}.submissions']
         )
         self.resultss = database['resultss']
+        self.versions = database['versions']
         self.mapping = {
             'email': self._add_email,
             'option': self._add_option,
@@ -25,6 +168,8 @@ class Alligator:
             'text': self._add_text,
         }
         self.project = {}
+        self.stream = {}
+        self.crosstabs = {}
         self.group = {
             '_id': self.survey_id,
             'count': {'$sum': 1},
@@ -37,8 +182,13 @@ class Alligator:
         }
 
     def _add_email(self, field, index):
-        """Add commands to deal with email field to results pipeline."""
-        pass
+        """Add commands to deal with email field to results pipeline.
+
+        Like text fields, email fields are summarized locally instead of
+        being part of the aggregation pipeline.
+
+        """
+        self.stream[str(index)] = EmailSummary
 
     def _add_option(self, field, index):
         """Add commands to deal with option field to results pipeline."""
@@ -59,13 +209,40 @@ class Alligator:
         self._add_radio(field, index)
 
     def _add_text(self, field, index):
-        """Add commands to deal with text field to results pipeline."""
-        pass
+        """Add commands to deal with text field to results pipeline.
+
+        Text fields are not part of the aggregation pipeline. Instead, their
+        answers are streamed from the database afterwards and summarized
+        locally.
+
+        """
+        self.stream[str(index)] = TextSummary
+
+    def _compile(self):
+        """Define the pipeline parts for all fields of the survey.
+
+        The pipeline parts are shared between surveys with the same field
+        structure. Only the group identifier differs between them, which is
+        why it is excluded from the shared parts.
+
+        """
+        identifier = fingerprint(self.configuration['fields'])
+        if identifier not in PIPELINES:
+            for index, field in enumerate(self.configuration['fields']):
+                self.mapping[field['type']](field, index+1)
+            PIPELINES[identifier] = (
+                self.project,
+                {k: v for k, v in self.group.items() if k != '_id'},
+                self.stream,
+            )
+        project, group, stream = PIPELINES[identifier]
+        self.project = project
+        self.group = {'_id': self.survey_id, **group}
+        self.stream = stream
 
     def _build_pipeline(self):
         """Build the aggregation pipeline used in pymongo's aggregate call."""
-        for index, field in enumerate(self.configuration['fields']):
-            self.mapping[field['type']](field, index+1)
+        self._compile()
         pipeline = []
         if self.project:
             pipeline.append({'$project': self.project})
@@ -85,27 +262,393 @@ class Alligator:
                 e[key] = value
         return e
 
-    async def fetch(self):
-        """Aggregate and return the results of the survey."""
+    async def _partition(self):
+        """Return range expressions that split the submissions into parts.
+
+        The boundaries are the quantiles of a random sample of submission ids.
+        MongoDB only compares values of the same type in range queries, which
+        is why this relies on the ids of a collection being of a single type,
+        as is the case for all of our submission collections.
+
+        """
+        cursor = self.collection.aggregate([
+            {'$sample': {'size': self.SAMPLES * self.partitions}},
+            {'$project': {'_id': True}},
+            {'$sort': {'_id': 1}},
+        ])
+        identifiers = [e['_id'] for e in await cursor.to_list(None)]
+        boundaries = []
+        for i in range(1, self.partitions):
+            boundary = identifiers[len(identifiers) * i // self.partitions]
+            if not boundaries or boundary != boundaries[-1]:
+                boundaries.append(boundary)
+        if not boundaries:
+            return [{}]
+        expressions = [{'_id': {'$lt': boundaries[0]}}]
+        for lower, upper in zip(boundaries, boundaries[1:]):
+            expressions.append({'_id': {'$gte': lower, '$lt': upper}})
+        expressions.append({'_id': {'$gte': boundaries[-1]}})
+        return expressions
+
+    async def _aggregate(self, expression):
+        """Aggregate the submissions matching the expression and return them.
+
+        In contrast to the full pipeline, the partial results are returned
+        instead of being merged into the results collection.
+
+        """
+        pipeline = [{'$match': expression}]
+        if self.project:
+            pipeline.append({'$project': self.project})
+        pipeline.append({'$group': {**self.group, '_id': None}})
+        cursor = self.collection.aggregate(pipeline, allowDiskUse=True)
+        return await cursor.to_list(None)
+
+    async def _aggregate_partitioned(self):
+        """Aggregate partitions of the submissions concurrently.
+
+        Instead of running a single long aggregation, the submissions are
+        split into ranges of their ids, which are aggregated concurrently and
+        can thus be processed by multiple database threads. As all grouped
+        values are sums, the partial results are merged by adding them up.
+
+        """
+        self._build_pipeline()
+        expressions = await self._partition()
+        partialss = await asyncio.gather(*[
+            self._aggregate(expression)
+            for expression
+            in expressions
+        ])
+        results = {'_id': self.survey_id}
+        for partials in partialss:
+            for partial in partials:
+                for key, value in partial.items():
+                    if key != '_id':
+                        results[key] = results.get(key, 0) + value
+        await self.resultss.replace_one(
+            filter={'_id': self.survey_id},
+            replacement=results,
+            upsert=True,
+        )
+        if self.stream:
+            summariess = await asyncio.gather(*[
+                self._summarize(expression)
+                for expression
+                in expressions
+            ])
+            summaries = summariess[0]
+            for partials in summariess[1:]:
+                for index, summary in summaries.items():
+                    summary.merge(partials[index])
+            await self._store(summaries)
+
+    async def _aggregate_vectorized(self):
+        """Aggregate the submissions locally with column-wise sums.
+
+        For surveys of moderate size, transferring the boolean values and
+        summing them locally is cheaper than running the aggregation pipeline
+        and merging its output into the results collection. The submissions
+        are streamed in batches, each batch is split into one column per
+        grouped value, and the true values of each column are counted.
+        Columns are extracted one nesting level at a time, the levels being
+        shared between the columns below them, e.g. the options of a radio
+        field, such that there is no per-value Python loop. Summarized fields
+        are processed in the same pass. The results are identical to the
+        ones of the aggregation pipeline.
+
+        """
+        self._build_pipeline()
+        keys = [
+            key
+            for key
+            in self.group.keys()
+            if key not in ['_id', 'count']
+        ]
+        paths = [
+            tuple(self.group[key]['$sum'][1:].split('.')[1:])
+            for key
+            in keys
+        ]
+        prefixes = sorted(
+            {path[:i] for path in paths for i in range(1, len(path) + 1)},
+            key=len,
+        )
+        summaries = {index: cls() for index, cls in self.stream.items()}
+        projection = {'_id': False}
+        projection.update({self.group[key]['$sum'][1:]: True for key in keys})
+        projection.update({f'data.{index}': True for index in summaries})
+        sums = numpy.zeros(len(keys), dtype=numpy.int64)
+        count = 0
+        batch = []
+
+        def _reduce():
+            """Add the column sums of the current batch to the total sums."""
+            nonlocal count
+            if batch:
+                columns = {(): batch}
+                for prefix in prefixes:
+                    columns[prefix] = [
+                        value.get(prefix[-1]) if type(value) is dict else None
+                        for value
+                        in columns[prefix[:-1]]
+                    ]
+                sums[:] += numpy.fromiter(
+                    (columns[path].count(True) for path in paths),
+                    dtype=numpy.int64,
+                    count=len(paths),
+                )
+                count += len(batch)
+                batch.clear()
+
+        cursor = self.collection.find(
+            filter={},
+            projection=projection,
+            batch_size=self.BATCH_SIZE,
+        )
+        async for submission in cursor:
+            data = submission['data']
+            batch.append(data)
+            for index, summary in summaries.items():
+                value = data.get(index)
+                if value is not None:
+                    summary.add(value)
+            if len(batch) == self.BATCH_SIZE:
+                _reduce()
+        _reduce()
+        results = {'_id': self.survey_id, 'count': count}
+        results.update({key: int(value) for key, value in zip(keys, sums)})
+        await self.resultss.replace_one(
+            filter={'_id': self.survey_id},
+            replacement=results,
+            upsert=True,
+        )
+        if summaries:
+            await self._store(summaries)
+
+    async def _summarize(self, expression):
+        """Stream the answers of summarized fields and return the summaries."""
+        summaries = {index: cls() for index, cls in self.stream.items()}
+        cursor = self.collection.find(
+            filter=expression,
+            projection={
+                f'data.{index}': True
+                for index
+                in self.stream.keys()
+            },
+        )
+        async for submission in cursor:
+            for index, summary in summaries.items():
+                value = submission['data'].get(index)
+                if value is not None:
+                    summary.add(value)
+        return summaries
+
+    async def _store(self, summaries):
+        """Add the summaries of the summarized fields to the results.
+
+        Besides the summaries, we store the serialized HyperLogLog registers
+        under the `sketches` key, which is excluded when fetching results.
+
+        """
+        update = {}
+        for index, summary in summaries.items():
+            update[index] = summary.result()
+            if isinstance(summary.sketch, HyperLogLog):
+                update[f'sketches.{index}'] = summary.sketch.serialize()
+        await self.resultss.update_one(
+            filter={'_id': self.survey_id},
+            update={'$set': update},
+        )
+
+    def _categorize(self, index):
+        """Return result keys and submission paths of a categorical field."""
+        field = self.configuration['fields'][index-1]
+        if field['type'] == 'option':
+            return [('1', f'data.{index}')]
+        return [
+            (str(i+1), f'data.{index}.{i+1}')
+            for i
+            in range(len(field['fields']))
+        ]
+
+    async def crosstab(self, row, column):
+        """Return the joint answer counts of two categorical fields.
+
+        The counts of all pairs of options are computed in a single `$group`
+        stage. The result of a field pair is cached until the submission
+        version changes. Option fields have the single category `1`, being
+        selected.
+
+        """
+        version = await self.fetch_version()
+        if (row, column) in self.crosstabs:
+            stamp, crosstab = self.crosstabs[(row, column)]
+            if stamp == version:
+                return crosstab
+        group = {'_id': None}
+        for rkey, rpath in self._categorize(row):
+            for ckey, cpath in self._categorize(column):
+                group[f'{rkey}+{ckey}'] = {
+                    '$sum': {
+                        '$cond': [{'$and': [f'${rpath}', f'${cpath}']}, 1, 0],
+                    },
+                }
+        cursor = self.collection.aggregate([{'$group': group}])
+        counts = await cursor.to_list(None)
+        crosstab = {}
+        for key in group.keys():
+            if key != '_id':
+                rkey, ckey = key.split('+')
+                crosstab.setdefault(rkey, {})
+                crosstab[rkey][ckey] = counts[0][key] if counts else 0
+        self.crosstabs[(row, column)] = version, crosstab
+        return crosstab
+
+    async def invalidate(self):
+        """Increment the submission version, invalidating cached results.
+
+        The version is never decremented or deleted, not even when a survey
+        is reset or deleted. Otherwise, a cached result could carry the same
+        version as the new, different submission data.
+
+        """
+        await self.versions.update_one(
+            filter={'_id': self.survey_id},
+            update={'$inc': {'version': 1}},
+            upsert=True,
+        )
+
+    async def fetch_version(self):
+        """Return the current submission version of the survey."""
+        document = await self.versions.find_one(
+            filter={'_id': self.survey_id},
+            projection={'_id': False, 'version': True},
+        )
+        return document['version'] if document is not None else 0
+
+    async def _fetch(self, version):
+        """Aggregate and return the results of the survey and their JSON.
+
+        Results are stamped with the submission version they were computed
+        at. The version is read before aggregating, which is why results
+        stamped with the current version can never be stale. Revalidating
+        cached results thus only takes reading the version, and unchanged
+        results are never recomputed, neither by this worker nor by others.
+        The results are cached together with their serialized JSON bytes,
+        such that they do not need to be encoded again for every response.
+
+        """
+        if version is None:
+            version = await self.fetch_version()
+        if self.survey_id in self.cache:
+            stamp, results, dump = self.cache[self.survey_id]
+            if stamp == version:
+                return results, dump
         results = await self.resultss.find_one(
             filter={'_id': self.survey_id},
-            projection={'_id': False},
+            projection={'_id': False, 'sketches': False},
         )
-        if results is None:
+        if results is None or results.get('version') != version:
 
 
             # TODO do something if there are no submissions
             # maybe it's better to simply check if the collection exists?
-            if await self.collection.count_documents({}) == 0: return {}
+            count = await self.collection.count_documents({})
+            if count == 0:
+                self.cache[self.survey_id] = version, {}, b'{}'
+                return {}, b'{}'
 
 
-            cursor = self.collection.aggregate(
-                pipeline=self._build_pipeline(),
-                allowDiskUse=True,
-            )
-            async for _ in cursor: pass  # make sure that the aggregation finished
-            results = await self.resultss.find_one(
+            if count <= self.threshold:
+                await self._aggregate_vectorized()
+            elif self.partitions > 1:
+                await self._aggregate_partitioned()
+            else:
+                cursor = self.collection.aggregate(
+                    pipeline=self._build_pipeline(),
+                    allowDiskUse=True,
+                )
+                async for _ in cursor: pass  # make sure that the aggregation finished
+                if self.stream:
+                    await self._store(await self._summarize({}))
+            results = await self.resultss.find_one_and_update(
                 filter={'_id': self.survey_id},
-                projection={'_id': False},
+                update={'$set': {'version': version}},
+                projection={'_id': False, 'sketches': False},
+                return_document=ReturnDocument.AFTER,
             )
-        return self._restructure(results)
+            if results is None:
+                # the results were deleted meanwhile, e.g. by a reset, which
+                # also invalidated the version that we aggregated at
+                return await self._fetch(None)
+        del results['version']
+        results = self._restructure(results)
+        dump = orjson.dumps(results)
+        self.cache[self.survey_id] = version, results, dump
+        return results, dump
+
+    async def fetch(self, version=None):
+        """Aggregate and return the results of the survey.
+
+        Callers that already read the submission version can pass it along.
+
+        """
+        results, _ = await self._fetch(version)
+        return results
+
+    async def fetch_serialized(self, version=None):
+        """Aggregate and return the results of the survey as JSON bytes."""
+        _, dump = await self._fetch(version)
+        return dump
+
+
+class Histogram:
+    """Rolls up submission counts into minute, hour and day buckets.
+
+    Each submission increments its buckets in a rollup document that holds
+    all buckets of a single day. This keeps the documents small for long
+    running surveys, and lets us read the histogram of a survey without
+    touching the submissions themselves.
+
+    """
+
+    def __init__(self, configuration, database):
+        """Initialize histogram for the survey of the given configuration."""
+        self.survey_id = combine(
+            configuration['username'],
+            configuration['survey_name'],
+        )
+        self.histograms = database['histograms']
+
+    async def add(self, timestamp):
+        """Count a submission at the given unix time in the rollups."""
+        day = timestamp - timestamp % (24*60*60)
+        hour = timestamp - timestamp % (60*60)
+        minute = timestamp - timestamp % 60
+        await self.histograms.update_one(
+            filter={'_id': f'{self.survey_id}.{day}'},
+            update={
+                '$setOnInsert': {'survey_id': self.survey_id, 'day': day},
+                '$inc': {
+                    'count': 1,
+                    f'hours.{hour}': 1,
+                    f'minutes.{minute}': 1,
+                },
+            },
+            upsert=True,
+        )
+
+    async def fetch(self):
+        """Return the submission counts of the survey per time bucket."""
+        histogram = {'minute': {}, 'hour': {}, 'day': {}}
+        cursor = self.histograms.find(
+            filter={'survey_id': self.survey_id},
+            projection={'_id': False},
+            sort=[('day', ASCENDING)],
+        )
+        async for rollup in cursor:
+            histogram['day'][str(rollup['day'])] = rollup['count']
+            histogram['hour'].update(rollup['hours'])
+            histogram['minute'].update(rollup['minutes'])
+        return histogram
@@ -0,0 +1,79 @@
+import sys
+import math
+
+from cachetools import TTLCache
+
+
+def sizeof(value):
+    """Estimate the memory footprint of a JSON-like value in bytes."""
+    size = sys.getsizeof(value)
+    if type(value) is dict:
+        size += sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    if type(value) is list:
+        size += sum(sizeof(e) for e in value)
+    return size
+
+
+class SurveyCache(TTLCache):
+    """LRU cache bounded by the estimated memory use of its entries.
+
+    Surveys differ vastly in size, e.g. a survey with hundreds of fields and
+    long descriptions takes orders of magnitude more memory than one with a
+    single field. Counting entries is thus a poor bound, which is why the
+    cache sums up the `size` that each cached object reports. Optionally,
+    entries expire after some time to live. The cache keeps statistics about
+    its hits, misses and evictions.
+
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        """Initialize a cache holding at most maxsize bytes."""
+        super().__init__(
+            maxsize=maxsize,
+            ttl=ttl if ttl is not None else math.inf,
+            getsizeof=lambda value: value.size,
+        )
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Return the cached value and count the cache hit or miss."""
+        if key in self:
+            self.hits += 1
+            return self[key]
+        self.misses += 1
+        return default
+
+    def resize(self, key, value):
+        """Update the size of a cached value after it has grown.
+
+        The value is inserted again, evicting least recently used entries if
+        needed, or dropped if it no longer fits into the cache at all. Note
+        that inserting the value again also restarts its time to live.
+
+        """
+        if key in self and self[key] is value:
+            del self[key]
+            try:
+                self[key] = value
+            except ValueError:
+                pass
+
+    def popitem(self):
+        """Evict the least recently used entry and count the eviction."""
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+    @property
+    def statistics(self):
+        """Return the current usage and the statistics of the cache."""
+        return {
+            'entries': len(self),
+            'bytes': self.currsize,
+            'max_bytes': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
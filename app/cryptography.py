@@ -7,6 +7,7 @@ from fastapi import HTTPException
 from jwt import ExpiredSignatureError, InvalidSignatureError, InvalidTokenError
 
 from app.utils import now
+from app.tracing import traced
 
 
 # public JSON Web Token signature key
@@ -25,10 +26,12 @@ class PasswordManager:
             deprecated='auto',
         )
 
+    @traced('PasswordManager.hash_password')
     def hash_password(self, password):
         """Hash the given password and return the hash as string."""
         return self.context.hash(password)
 
+    @traced('PasswordManager.verify_password')
     def verify_password(self, password, pwdhash):
         """Return true if the password results in the hash, else False."""
         return self.context.verify(password, pwdhash)
@@ -41,6 +44,7 @@ class PasswordManager:
 class TokenManager:
     """The TokenManager manages encoding and decoding JSON Web Tokens."""
 
+    @traced('TokenManager.generate')
     def generate(self, username):
         """Generate JWT access token containing username and expiration."""
         timestamp = now()
@@ -58,6 +62,7 @@ class TokenManager:
         if username != self.decode(access_token):
             raise HTTPException(401, 'unauthorized')
 
+    @traced('TokenManager.decode')
     def decode(self, access_token):
         """Decode the given JWT access token and return the username.
 
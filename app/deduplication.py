@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import hashlib
+
+import orjson
+
+from cachetools import LRUCache
+from pymongo.errors import DuplicateKeyError
+
+from app.sketches import ScalableBloomFilter
+from app.tracing import traced
+
+
+logger = logging.getLogger(__name__)
+
+
+class DuplicateGuard:
+    """Detects repeated identical submissions to open surveys.
+
+    Open surveys do not authenticate their respondents, such that bots and
+    double clicks easily store the same submission many times. Looking up
+    every submission in the database would double the round trips of the
+    submit route, so the guard instead keeps a scalable Bloom filter of the
+    submission fingerprints per survey in memory. A fingerprint combines
+    the normalized submission with a client hint, e.g. the address and the
+    user agent of the client. Respondents sharing both, e.g. behind the
+    same proxy, are thus rejected when they give identical answers, which
+    is why surveys opt into the guard via their configuration. As with
+    every Bloom filter, a small fraction of the submissions are wrongly
+    considered to be duplicates.
+
+    Filters are loaded lazily from the database and regularly persisted,
+    such that restarts do not reset them, though filters evicted from
+    memory lose the fingerprints added since they were last persisted.
+    The bits of every filter are stored in slices of bounded size, each
+    slice being merged with its stored version before it is written, such
+    that multiple workers add up their fingerprints instead of overwriting
+    each other's.
+
+    """
+
+    # seconds between two persistences of the modified filters
+    INTERVAL = 60
+    # maximum number of filters kept in memory
+    MAXSIZE = 1024
+    # maximum number of bytes of a filter stored in a single document
+    SLICE = 2**20
+
+    def __init__(self, database):
+        """Initialize a duplicate guard instance."""
+        self.database = database
+        self.filters = LRUCache(maxsize=self.MAXSIZE)
+        self.modified = set()
+        self.task = None
+
+    def start(self):
+        """Start periodically persisting the filters in the background."""
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and persist the filters a last time."""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.persist()
+
+    async def _run(self):
+        """Persist the modified filters in regular intervals."""
+        while True:
+            await asyncio.sleep(self.INTERVAL)
+            try:
+                await self.persist()
+            except Exception:
+                logger.exception('persisting duplicate filters failed')
+
+    @staticmethod
+    def fingerprint(submission, hint):
+        """Hash the normalized submission together with the client hint."""
+
+        def normalize(value):
+            """Strip surrounding whitespace and case off all strings."""
+            if type(value) is str:
+                return value.strip().casefold()
+            if type(value) is dict:
+                return {k: normalize(v) for k, v in value.items()}
+            return value
+
+        dump = orjson.dumps(
+            [normalize(submission), hint],
+            option=orjson.OPT_SORT_KEYS,
+        )
+        return hashlib.sha256(dump).hexdigest()
+
+    async def load(self, survey_id):
+        """Return the filter of the survey, merging its stored slices."""
+        bloom = self.filters.get(survey_id)
+        if bloom is None:
+            cursor = self.database['filters'].find(
+                filter={'survey_id': survey_id},
+                projection={'_id': False, 'survey_id': False},
+            )
+            slices = await cursor.to_list(None)
+            bloom = self.filters.get(survey_id)
+            if bloom is None:
+                bloom = ScalableBloomFilter()
+                for document in sorted(slices, key=lambda x: x['filter']):
+                    while len(bloom.filters) <= document['filter']:
+                        bloom.grow()
+                    bloom.filters[document['filter']].merge(
+                        document['bits'],
+                        document['offset'],
+                    )
+                for sub in bloom.filters:
+                    sub.count = sub.estimate()
+                self.filters[survey_id] = bloom
+        return bloom
+
+    async def contains(self, survey_id, fingerprint):
+        """Check if the fingerprint was probably added to the survey before."""
+        bloom = await self.load(survey_id)
+        return fingerprint in bloom
+
+    async def add(self, survey_id, fingerprint):
+        """Add the fingerprint of a successfully stored submission."""
+        bloom = await self.load(survey_id)
+        if bloom.add(fingerprint):
+            self.modified.add(survey_id)
+
+    async def _merge(self, survey_id, index, offset, sub):
+        """Merge a slice of a filter with its stored version and store it.
+
+        The stored slice is versioned, a concurrent write of another worker
+        makes the update miss, in which case we merge again. The bits that
+        other workers stored are kept in memory as well.
+
+        """
+        identifier = f'{survey_id}.{index}.{offset}'
+        while True:
+            bits = bytes(sub.bits[offset:offset + self.SLICE])
+            stored = await self.database['filters'].find_one(
+                filter={'_id': identifier},
+                projection={'bits': True, 'version': True},
+            )
+            if stored is None:
+                try:
+                    await self.database['filters'].insert_one({
+                        '_id': identifier,
+                        'survey_id': survey_id,
+                        'filter': index,
+                        'offset': offset,
+                        'bits': bits,
+                        'version': 0,
+                    })
+                    return
+                except DuplicateKeyError:
+                    continue
+            sub.merge(stored['bits'], offset)
+            bits = bytes(sub.bits[offset:offset + self.SLICE])
+            result = await self.database['filters'].update_one(
+                filter={'_id': identifier, 'version': stored['version']},
+                update={
+                    '$set': {'bits': bits},
+                    '$inc': {'version': 1},
+                },
+            )
+            if result.matched_count == 1:
+                return
+
+    async def _persist(self, survey_id, bloom):
+        """Merge all slices of the survey's filter into the database."""
+        await asyncio.gather(*[
+            self._merge(survey_id, index, offset, sub)
+            for index, sub
+            in enumerate(list(bloom.filters))
+            for offset
+            in range(0, len(sub.bits), self.SLICE)
+        ])
+
+    @traced('DuplicateGuard.persist')
+    async def persist(self):
+        """Persist all filters modified since they were last persisted.
+
+        Filters that fail to be persisted stay marked as modified, such
+        that they are retried the next time.
+
+        """
+        modified, self.modified = self.modified, set()
+        modified = [
+            (survey_id, self.filters[survey_id])
+            for survey_id
+            in modified
+            if survey_id in self.filters
+        ]
+        results = await asyncio.gather(
+            *[
+                self._persist(survey_id, bloom)
+                for survey_id, bloom
+                in modified
+            ],
+            return_exceptions=True,
+        )
+        errors = []
+        for (survey_id, _), result in zip(modified, results):
+            if isinstance(result, Exception):
+                self.modified.add(survey_id)
+                errors.append(result)
+        if errors:
+            raise errors[0]
+
+    async def discard(self, survey_id):
+        """Forget all fingerprints of the survey, e.g. when it is reset."""
+        self.filters.pop(survey_id, None)
+        self.modified.discard(survey_id)
+        await self.database['filters'].delete_many({'survey_id': survey_id})
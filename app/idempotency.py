@@ -0,0 +1,176 @@
+import os
+import contextvars
+
+import orjson
+
+from fastapi import HTTPException
+from starlette.responses import Response
+from pymongo.errors import DuplicateKeyError
+from cachetools import TTLCache
+
+from app.utils import now, digest
+
+
+# seconds for which responses are replayed for the same idempotency key
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 24*60*60))
+# seconds after which claims without response are considered abandoned
+IDEMPOTENCY_LEASE = int(os.getenv('IDEMPOTENCY_LEASE', 60))
+
+
+# claim of the request that is currently processed with an idempotency key
+CLAIM = contextvars.ContextVar('claim', default=None)
+
+
+def commit():
+    """Mark that the current request has written to the database.
+
+    Failures after this point are stored and replayed like responses,
+    as releasing the claim would let a retry write a second time.
+
+    """
+    claim = CLAIM.get()
+    if claim is not None:
+        claim['committed'] = True
+
+
+class IdempotencyManager:
+    """Replays the original response to retried requests.
+
+    Clients on flaky networks retry requests whose responses got lost, e.g.
+    submitting twice stores the submission twice and sends two verification
+    emails. Clients can thus send an `Idempotency-Key` header, in which case
+    the first request with that key claims it in the database and stores
+    its response once it is done. Retries with the same key get the stored
+    response without processing the request again, and are answered with
+    409 while the first request is still in progress. Requests that fail
+    before they write to the database release their claim so that they can
+    be retried, later failures are stored like responses. Claims are
+    leased, such that a retry can take over the claim of a request whose
+    worker died before storing its response, once the lease expired. Recent
+    responses are additionally kept in memory to save the database round
+    trip.
+
+    """
+
+    # maximum number of responses kept in memory
+    MAXSIZE = 4096
+    # response headers that are stored and replayed
+    HEADERS = ['content-type', 'location', 'retry-after']
+
+    def __init__(self, database):
+        """Initialize an idempotency manager instance."""
+        self.database = database
+        self.cache = TTLCache(maxsize=self.MAXSIZE, ttl=IDEMPOTENCY_TTL)
+
+    @staticmethod
+    def _replay(record):
+        """Reconstruct the response stored in the given record."""
+        return Response(
+            content=record['content'],
+            status_code=record['status_code'],
+            headers=record['headers'],
+        )
+
+    @classmethod
+    def _record(cls, result):
+        """Convert the result of a route into a storable response record."""
+        if not isinstance(result, Response):
+            result = Response(
+                content=orjson.dumps(result),
+                media_type='application/json',
+            )
+        return {
+            'status_code': result.status_code,
+            'headers': {
+                key: value
+                for key, value
+                in result.headers.items()
+                if key in cls.HEADERS
+            },
+            'content': bytes(result.body),
+        }
+
+    @classmethod
+    def _failure(cls, error):
+        """Convert the error of a route into a storable response record."""
+        if isinstance(error, HTTPException):
+            status_code, detail = error.status_code, error.detail
+            headers = error.headers
+        else:
+            status_code, detail = 500, 'internal server error'
+            headers = None
+        return cls._record(Response(
+            content=orjson.dumps({'detail': detail}),
+            status_code=status_code,
+            headers=headers,
+            media_type='application/json',
+        ))
+
+    async def _store(self, identifier, record):
+        """Store the response record of the claimed key."""
+        await self.database['idempotency'].update_one(
+            filter={'_id': identifier},
+            update={'$set': {'response': record}},
+        )
+        self.cache[identifier] = record
+
+    async def execute(self, scope, key, function):
+        """Process the request once per key and replay it on retries.
+
+        The scope, e.g. the survey identifier, separates the keys of
+        different resources. Without key, the request is processed normally.
+
+        """
+        if key is None:
+            return await function()
+        identifier = f'{scope}.{digest(key)}'
+        record = self.cache.get(identifier)
+        if record is not None:
+            return self._replay(record)
+        timestamp = now()
+        try:
+            await self.database['idempotency'].insert_one({
+                '_id': identifier,
+                'creation_time': timestamp,
+                'claim_time': timestamp,
+                'response': None,
+            })
+        except DuplicateKeyError:
+            entry = await self.database['idempotency'].find_one(
+                filter={'_id': identifier},
+            )
+            if entry is not None and entry['response'] is not None:
+                self.cache[identifier] = entry['response']
+                return self._replay(entry['response'])
+            if (
+                    entry is None
+                    or entry['claim_time'] > timestamp - IDEMPOTENCY_LEASE
+            ):
+                raise HTTPException(409, 'request is still in progress')
+            result = await self.database['idempotency'].update_one(
+                filter={
+                    '_id': identifier,
+                    'claim_time': entry['claim_time'],
+                    'response': None,
+                },
+                update={'$set': {'claim_time': timestamp}},
+            )
+            if result.matched_count == 0:
+                raise HTTPException(409, 'request is still in progress')
+        claim = {'committed': False}
+        token = CLAIM.set(claim)
+        try:
+            result = await function()
+        except BaseException as error:
+            if claim['committed']:
+                await self._store(identifier, self._failure(error))
+            else:
+                await self.database['idempotency'].delete_one(
+                    {'_id': identifier},
+                )
+            raise
+        finally:
+            CLAIM.reset(token)
+        record = self._record(result)
+        await self._store(identifier, record)
+        return self._replay(record)
@@ -0,0 +1,172 @@
+import time
+import logging
+import contextvars
+
+from app.tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+
+# database round trips of the request that is currently processed
+ROUNDTRIPS = contextvars.ContextVar('roundtrips', default=None)
+
+
+class RoundTrips:
+    """Counts the database round trips of a request and their duration."""
+
+    def __init__(self):
+        """Initialize a counter without any round trips."""
+        self.count = 0
+        self.seconds = 0
+
+    def header(self):
+        """Return the round trips formatted as `Server-Timing` header."""
+        return (
+            f'db;dur={self.seconds * 1000:.3f};'
+            f'desc="{self.count} round trips"'
+        )
+
+
+def _record(start, count=1):
+    """Add round trips started at the given time to the current request."""
+    roundtrips = ROUNDTRIPS.get()
+    if roundtrips is not None:
+        roundtrips.count += count
+        roundtrips.seconds += time.perf_counter() - start
+
+
+class InstrumentedStorage:
+    """Wraps a storage engine to count the round trips of every request.
+
+    Every awaited collection operation counts as a round trip, as does
+    every cursor that is iterated, regardless of how many batches it
+    fetches. The operations are attributed to the request whose context
+    they run in, operations outside of requests, e.g. of background tasks,
+    are not counted.
+
+    """
+
+    def __init__(self, engine):
+        """Wrap the given storage engine."""
+        self.engine = engine
+
+    def __getattr__(self, name):
+        """Pass other attributes through to the storage engine."""
+        return getattr(self.engine, name)
+
+    def __getitem__(self, name):
+        """Return the instrumented collection of the given name."""
+        return InstrumentedCollection(self.engine[name])
+
+
+class InstrumentedCollection:
+    """Wraps a collection to count its operations as round trips."""
+
+    # operations that return cursors instead of coroutines
+    CURSORS = {'find', 'aggregate'}
+
+    def __init__(self, collection):
+        """Wrap the given collection."""
+        self.collection = collection
+        self.name = collection.name
+
+    def __getattr__(self, name):
+        """Return the operation of the given name wrapped in a counter."""
+        operation = getattr(self.collection, name)
+        if not callable(operation):
+            return operation
+        if name in self.CURSORS:
+
+            def _cursor(*args, **kwargs):
+                """Return the operation's cursor wrapped in a counter."""
+                return InstrumentedCursor(
+                    operation(*args, **kwargs),
+                    f'mongodb.{name}',
+                    self.name,
+                )
+
+            return _cursor
+
+        async def _operation(*args, **kwargs):
+            """Await the operation and count it as round trip."""
+            start = time.perf_counter()
+            try:
+                with span(f'mongodb.{name}', collection=self.name):
+                    return await operation(*args, **kwargs)
+            finally:
+                _record(start)
+
+        return _operation
+
+
+class InstrumentedCursor:
+    """Wraps a cursor to count its iteration as round trip.
+
+    The initial query of the cursor is traced as span. Fetching further
+    batches is not, as the span would stay active while the caller processes
+    the documents between the batches.
+
+    """
+
+    def __init__(self, cursor, name, collection):
+        """Wrap the given cursor of the named operation."""
+        self.cursor = cursor
+        self.name = name
+        self.collection = collection
+
+    async def to_list(self, length):
+        """Return the documents of the cursor as list."""
+        start = time.perf_counter()
+        try:
+            with span(self.name, collection=self.collection):
+                return await self.cursor.to_list(length)
+        finally:
+            _record(start)
+
+    def __aiter__(self):
+        """Iterate the cursor, measuring only the time spent waiting."""
+        return self._iterate()
+
+    @staticmethod
+    async def _next(iterator):
+        """Return the next document, or None if the cursor is exhausted."""
+        try:
+            return await iterator.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    async def _iterate(self):
+        iterator = self.cursor.__aiter__()
+        start = time.perf_counter()
+        with span(self.name, collection=self.collection):
+            document = await self._next(iterator)
+        _record(start)
+        while document is not None:
+            yield document
+            start = time.perf_counter()
+            document = await self._next(iterator)
+            _record(start, 0)
+
+
+async def instrument(request, call_next):
+    """Count the request's round trips and report them in the response."""
+    roundtrips = RoundTrips()
+    token = ROUNDTRIPS.set(roundtrips)
+    try:
+        with span(
+            f'{request.method} {request.url.path}',
+            method=request.method,
+            path=request.url.path,
+        ) as attributes:
+            response = await call_next(request)
+            attributes['status_code'] = response.status_code
+            attributes['roundtrips'] = roundtrips.count
+    finally:
+        ROUNDTRIPS.reset(token)
+    response.headers['Server-Timing'] = roundtrips.header()
+    logger.info(
+        f'{request.method} {request.url.path} {response.status_code} '
+        f'{roundtrips.count} round trips {roundtrips.seconds * 1000:.1f}ms'
+    )
+    return response
@@ -1,6 +1,8 @@
 import os
 import httpx
 
+from app.tracing import traced
+
 
 # development / production / testing environment
 ENVIRONMENT = os.getenv('ENVIRONMENT')
@@ -22,6 +24,7 @@ class Letterbox:
             base_url=f'https://api.eu.mailgun.net/v3/email.{self.domain}',
         )
 
+    @traced('Letterbox.send')
     async def send(self, receiver, subject, html):
         """Send an email to the given receiver."""
         data = {
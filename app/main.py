@@ -1,14 +1,23 @@
 import os
 
+from typing import List
+
 from fastapi import FastAPI, Path, Query, Body, Form, HTTPException, Depends
-from motor.motor_asyncio import AsyncIOMotorClient
+from fastapi import Header, Request
 from fastapi.security import OAuth2PasswordBearer
-from pymongo import MongoClient, ASCENDING
+from fastapi.openapi.utils import get_openapi
+from pymongo import ASCENDING, DESCENDING
 
 from app.mailing import Letterbox
 from app.account import AccountManager
 from app.survey import SurveyManager
 from app.cryptography import TokenManager
+from app.scheduling import Scheduler
+from app.admission import LoadShedder
+from app.idempotency import IDEMPOTENCY_TTL
+from app import storage
+from app.instrumentation import InstrumentedStorage, instrument
+from app.utils import combine
 
 
 # check that required environment variables are set
@@ -21,7 +30,6 @@ assert all([
         'BACKEND_URL',
         'PUBLIC_RSA_KEY',
         'PRIVATE_RSA_KEY',
-        'MONGODB_CONNECTION_STRING',
         'MAILGUN_API_KEY',
     ]
 ])
@@ -31,18 +39,62 @@ assert all([
 ENVIRONMENT = os.getenv('ENVIRONMENT')
 # MongoDB connection string
 MONGODB_CONNECTION_STRING = os.getenv('MONGODB_CONNECTION_STRING')
-
-
-# connect to mongodb via pymongo
-client = MongoClient(MONGODB_CONNECTION_STRING)
-# get link to development / production / testing database
-database = client[ENVIRONMENT]
-# set up database indices synchronously via pymongo
+# storage engine, either motor (MongoDB) or memory
+STORAGE_ENGINE = os.getenv('STORAGE_ENGINE', 'motor')
+# check that the MongoDB connection string is set if needed
+assert STORAGE_ENGINE != 'motor' or MONGODB_CONNECTION_STRING
+# seconds of event loop lag from which low priority requests are shed
+SHEDDING_LAG = float(os.getenv('SHEDDING_LAG', 0.1))
+# requests in flight from which low priority requests are shed
+SHEDDING_INFLIGHT = int(os.getenv('SHEDDING_INFLIGHT', 256))
+# expose the statistics of caches and limits under /metrics
+METRICS = os.getenv('METRICS') == 'true'
+
+
+# connect to development / production / testing database
+engine = storage.create(
+    STORAGE_ENGINE,
+    MONGODB_CONNECTION_STRING,
+    ENVIRONMENT,
+)
+# get blocking link to the database
+database = engine.synchronous()
+# set up database indices synchronously
 database['configurations'].create_index(
     keys=[('username', ASCENDING), ('survey_name', ASCENDING)],
     name='username_survey_name_index',
     unique=True,
 )
+database['configurations'].create_index(
+    keys=[
+        ('username', ASCENDING),
+        ('start', DESCENDING),
+        ('survey_name', DESCENDING),
+    ],
+    name='username_start_survey_name_index',
+)
+database['configurations'].create_index(
+    keys='end',
+    name='end_index',
+)
+database['materializations'].create_index(
+    keys='creation_time',
+    name='creation_time_index',
+    expireAfterSeconds=2*Scheduler.LOOKBACK,
+)
+database['idempotency'].create_index(
+    keys='creation_time',
+    name='creation_time_index',
+    expireAfterSeconds=IDEMPOTENCY_TTL,
+)
+database['filters'].create_index(
+    keys=[('survey_id', ASCENDING), ('filter', ASCENDING)],
+    name='survey_id_filter_index',
+)
+database['histograms'].create_index(
+    keys=[('survey_id', ASCENDING), ('day', ASCENDING)],
+    name='survey_id_day_index',
+)
 database['accounts'].create_index(
     keys='email_address',
     name='email_address_index',
@@ -59,14 +111,26 @@ database['accounts'].create_index(
     expireAfterSeconds=10*60,  # delete draft accounts after 10 mins
     partialFilterExpression={'verified': {'$eq': False}},
 )
+# invitations are stored per survey, new surveys set up their own index
+for configuration in database['configurations'].find(
+        filter={'authentication': 'invitation'},
+        projection={'_id': False, 'username': True, 'survey_name': True},
+    ):
+    survey_id = combine(
+        configuration['username'],
+        configuration['survey_name'],
+    )
+    database[f'surveys.{survey_id}.invitations'].create_index(
+        keys='email_address',
+        name='email_address_index',
+        unique=True,
+    )
 
 
 # create fastapi app
 app = FastAPI()
-# connect to mongodb via motor
-client = AsyncIOMotorClient(MONGODB_CONNECTION_STRING)
-# get link to development / production / testing database
-database = client[ENVIRONMENT]
+# get asynchronous link to the database, counting round trips per request
+database = InstrumentedStorage(engine)
 # create email client
 letterbox = Letterbox()
 # create JWT manager
@@ -80,10 +144,79 @@ account_manager = AccountManager(
     token_manager,
     survey_manager,
 )
+# instantiate scheduler materializing the results of closed surveys
+scheduler = Scheduler(database, survey_manager)
+# shed requests when the server is overloaded
+load_shedder = LoadShedder(SHEDDING_LAG, SHEDDING_INFLIGHT)
 # fastapi password bearer
 oauth2_scheme = OAuth2PasswordBearer('/authentication')
 
 
+def openapi():
+    """Generate the OpenAPI schema, documenting the raw submission body.
+
+    The submit route reads the submission from the request itself, which
+    is why FastAPI does not document it and we add it to the schema here.
+
+    """
+    if app.openapi_schema is None:
+        schema = get_openapi(
+            title=app.title,
+            version=app.version,
+            routes=app.routes,
+        )
+        route = '/users/{username}/surveys/{survey_name}/submissions'
+        schema['paths'][route]['post']['requestBody'] = {
+            'content': {
+                'application/json': {
+                    'schema': {
+                        'title': 'Submission',
+                        'type': 'object',
+                        'description': 'The user submission',
+                    },
+                },
+            },
+            'required': True,
+        }
+        app.openapi_schema = schema
+    return app.openapi_schema
+
+
+app.openapi = openapi
+
+
+@app.on_event('startup')
+async def startup():
+    """Start the background tasks once the event loop is running."""
+    scheduler.start()
+    load_shedder.start()
+    if survey_manager.guard is not None:
+        survey_manager.guard.start()
+    survey_manager.start()
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    """Stop the background tasks before the event loop is closed."""
+    await survey_manager.stop()
+    await scheduler.stop()
+    await load_shedder.stop()
+    if survey_manager.guard is not None:
+        await survey_manager.guard.stop()
+
+
+@app.middleware('http')
+async def count(request, call_next):
+    """Report the database round trips of the request."""
+    return await instrument(request, call_next)
+
+
+@app.middleware('http')
+async def shed(request, call_next):
+    """Reject requests early when the server is overloaded."""
+    return await load_shedder.dispatch(request, call_next)
+
+
 @app.get('/users/{username}')
 async def fetch_user(
         username: str = Path(..., description='The username of the user'),
@@ -125,26 +258,38 @@ async def delete_user(
 @app.get('/users/{username}/surveys')
 async def fetch_configurations(
         username: str = Path(..., description='The username of the user'),
-        skip: int = Query(0, description='Index of the first configuration'),
-        limit: int = Query(10, description='Query limit; 0 means no limit'),
+        after: str = Query(None, description='Cursor of the previous page'),
+        limit: int = Query(10, ge=1, le=100, description='The page size'),
+        fields: List[str] = Query(None, description='The fields to return'),
         access_token: str = Depends(oauth2_scheme),
     ):
-    """Fetch the user's configurations sorted by the start date."""
+    """Fetch a page of the user's configurations sorted by the start date."""
     return await account_manager.fetch_configurations(
         username,
-        skip,
+        after,
         limit,
+        fields,
         access_token,
     )
 
 
+@app.get('/users/{username}/summaries')
+async def fetch_summaries(
+        username: str = Path(..., description='The username of the user'),
+        access_token: str = Depends(oauth2_scheme),
+    ):
+    """Fetch an overview of all the user's surveys with estimated counts."""
+    return await account_manager.fetch_summaries(username, access_token)
+
+
 @app.get('/users/{username}/surveys/{survey_name}')
 async def fetch_configuration(
         username: str = Path(..., description='The username of the user'),
         survey_name: str = Path(..., description='The name of the survey'),
+        if_none_match: str = Header(None, description='Cached ETags'),
     ):
     """Fetch the configuration document of a given survey."""
-    return await survey_manager.fetch(username, survey_name)
+    return await survey_manager.fetch(username, survey_name, if_none_match)
 
 
 @app.post('/users/{username}/surveys/{survey_name}')
@@ -191,13 +336,25 @@ async def delete_survey(
 
 @app.post('/users/{username}/surveys/{survey_name}/submissions')
 async def submit(
+        request: Request,
         username: str = Path(..., description='The username of the user'),
         survey_name: str = Path(..., description='The name of the survey'),
-        submission: dict = Body(..., description='The user submission'),
+        token: str = Query(None, description='The invitation token'),
+        idempotency_key: str = Header(None, description='Key of retries'),
     ):
-    """Validate submission and store it under pending submissions."""
-    survey = await survey_manager._fetch(username, survey_name)
-    return await survey.submit(submission)
+    """Validate submission and store it under pending submissions.
+
+    The submission body is read from the request directly instead of being
+    parsed by FastAPI, such that oversized bodies can be rejected early.
+
+    """
+    return await survey_manager.submit(
+        username,
+        survey_name,
+        request,
+        token,
+        idempotency_key,
+    )
 
 
 @app.delete('/users/{username}/surveys/{survey_name}/submissions')
@@ -210,28 +367,82 @@ async def reset_survey(
     await survey_manager.reset(username, survey_name, access_token)
 
 
+@app.post('/users/{username}/surveys/{survey_name}/invitations')
+async def invite(
+        username: str = Path(..., description='The username of the user'),
+        survey_name: str = Path(..., description='The name of the survey'),
+        email_addresses: List[str] = Body(..., description='The recipients'),
+        access_token: str = Depends(oauth2_scheme),
+    ):
+    """Issue one-time invitation tokens mapped to the email addresses."""
+    return await survey_manager.invite(
+        username,
+        survey_name,
+        email_addresses,
+        access_token,
+    )
+
+
 @app.get('/users/{username}/surveys/{survey_name}/verification/{token}')
 async def verify(
         username: str = Path(..., description='The username of the user'),
         survey_name: str = Path(..., description='The name of the survey'),
         token: str = Path(..., description='The verification token'),
+        idempotency_key: str = Header(None, description='Key of retries'),
     ):
     """Verify user token and either fail or redirect to success page."""
-    survey = await survey_manager._fetch(username, survey_name)
-    return await survey.verify(token)
+    return await survey_manager.verify(
+        username,
+        survey_name,
+        token,
+        idempotency_key,
+    )
 
 
 @app.get('/users/{username}/surveys/{survey_name}/results')
 async def aggregate(
         username: str = Path(..., description='The username of the user'),
         survey_name: str = Path(..., description='The name of the survey'),
+        if_none_match: str = Header(None, description='Cached ETags'),
     ):
     """Fetch the results of the given survey."""
 
     # TODO adapt result following authentication
 
     survey = await survey_manager._fetch(username, survey_name)
-    return await survey.aggregate()
+    return await survey.aggregate(if_none_match)
+
+
+@app.get('/users/{username}/surveys/{survey_name}/results/histogram')
+async def fetch_histogram(
+        username: str = Path(..., description='The username of the user'),
+        survey_name: str = Path(..., description='The name of the survey'),
+        access_token: str = Depends(oauth2_scheme),
+    ):
+    """Fetch the survey's submission counts per minute, hour and day."""
+    return await survey_manager.fetch_histogram(
+        username,
+        survey_name,
+        access_token,
+    )
+
+
+@app.get('/users/{username}/surveys/{survey_name}/results/crosstab')
+async def fetch_crosstab(
+        username: str = Path(..., description='The username of the user'),
+        survey_name: str = Path(..., description='The name of the survey'),
+        row: int = Query(..., description='The index of the first field'),
+        column: int = Query(..., description='The index of the second field'),
+        access_token: str = Depends(oauth2_scheme),
+    ):
+    """Fetch the joint answer counts of two categorical survey fields."""
+    return await survey_manager.fetch_crosstab(
+        username,
+        survey_name,
+        row,
+        column,
+        access_token,
+    )
 
 
 @app.post('/authentication')
@@ -248,3 +459,20 @@ async def verify_email_address(
         password: str = Form(..., description='The account password'),
     ):
     return await account_manager.verify(token, password)
+
+
+@app.get('/metrics')
+async def fetch_metrics():
+    """Fetch usage statistics of the server's caches and limits.
+
+    The statistics reveal internals of the server, which is why the route
+    is only available if it is explicitly enabled.
+
+    """
+    if not METRICS:
+        raise HTTPException(404, 'not found')
+    return {
+        'cache': survey_manager.cache.statistics,
+        'admission': survey_manager.admission.statistics,
+        'load': load_shedder.statistics,
+    }
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+
+from pymongo.errors import DuplicateKeyError
+
+from app.utils import combine, now
+from app.tracing import traced
+
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """Materializes the results of surveys as soon as they are closed.
+
+    Without the scheduler, the results are computed by the first request
+    after a survey closed, which is slow and, for popular surveys, tends to
+    coincide with a stampede of further requests. The scheduler regularly
+    looks for surveys that closed since its last check and computes their
+    results in the background. Every survey is claimed in the database
+    before being aggregated, such that multiple workers do not aggregate
+    the same survey.
+
+    """
+
+    # seconds between two checks for newly closed surveys
+    INTERVAL = 60
+    # seconds to look back for closed surveys when the scheduler starts
+    LOOKBACK = 24*60*60
+    # maximum number of surveys that are aggregated concurrently
+    CONCURRENCY = 4
+
+    def __init__(self, database, survey_manager):
+        """Initialize a scheduler instance."""
+        self.database = database
+        self.survey_manager = survey_manager
+        self.checkpoint = now() - self.LOOKBACK
+        self.task = None
+
+    def start(self):
+        """Start periodically materializing results in the background."""
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task of the scheduler."""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        """Materialize results of newly closed surveys in regular intervals."""
+        while True:
+            try:
+                await self.materialize()
+            except Exception:
+                logger.exception('materialization failed')
+            await asyncio.sleep(self.INTERVAL)
+
+    async def _materialize(self, username, survey_name):
+        """Claim the survey and compute and store its results.
+
+        The claim is released if the results cannot be computed, such that
+        the survey can be retried by the next check of any worker instead of
+        staying unmaterialized until the claim expires.
+
+        """
+        survey_id = combine(username, survey_name)
+        try:
+            await self.database['materializations'].insert_one({
+                '_id': survey_id,
+                'creation_time': now(),
+            })
+        except DuplicateKeyError:
+            return
+        try:
+            survey = await self.survey_manager._fetch(username, survey_name)
+            await survey.alligator.fetch()
+        except BaseException:
+            await self.database['materializations'].delete_one(
+                {'_id': survey_id},
+            )
+            raise
+
+    @traced('Scheduler.materialize')
+    async def materialize(self):
+        """Compute the results of all surveys closed since the last check.
+
+        Draft surveys are skipped. If surveys fail to be materialized, the
+        check point is only moved up to the earliest of them, such that they
+        are retried by the next check, though not longer than the lookback.
+        Surveys that were materialized already are skipped by their claim.
+
+        """
+        timestamp = now()
+        cursor = self.database['configurations'].find(
+            filter={
+                'draft': False,
+                'end': {'$gt': self.checkpoint, '$lte': timestamp},
+            },
+            projection={
+                '_id': False,
+                'username': True,
+                'survey_name': True,
+                'end': True,
+            },
+        )
+        configurations = await cursor.to_list(None)
+        semaphore = asyncio.Semaphore(self.CONCURRENCY)
+
+        async def _materialize(configuration):
+            """Materialize a single survey once the semaphore admits it."""
+            async with semaphore:
+                await self._materialize(
+                    configuration['username'],
+                    configuration['survey_name'],
+                )
+
+        outcomes = await asyncio.gather(
+            *[
+                _materialize(configuration)
+                for configuration
+                in configurations
+            ],
+            return_exceptions=True,
+        )
+        checkpoint = timestamp
+        for configuration, outcome in zip(configurations, outcomes):
+            if isinstance(outcome, Exception):
+                logger.error(
+                    f'materializing {configuration["survey_name"]} of '
+                    f'{configuration["username"]} failed: {outcome!r}'
+                )
+                checkpoint = min(checkpoint, configuration['end'] - 1)
+        self.checkpoint = max(checkpoint, timestamp - self.LOOKBACK)
@@ -0,0 +1,289 @@
+import heapq
+import hashlib
+import math
+
+
+class SpaceSaving:
+    """Approximates the most frequent items of a stream in bounded memory.
+
+    This is the Space-Saving algorithm by Metwally et al. At most `capacity`
+    items are counted at a time. When a new item arrives and all counters are
+    taken, the item with the smallest count is evicted and the new item
+    inherits its count. The counts are thus overestimated by at most the
+    recorded error, while items that are frequent enough are guaranteed to
+    be tracked. The item with the smallest count is found via a lazily
+    updated heap, which we rebuild whenever it grows too large.
+
+    """
+
+    def __init__(self, capacity):
+        """Initialize an empty summary with the given number of counters."""
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+
+    def _pop(self):
+        """Remove and return the count and the item with the smallest count."""
+        while True:
+            count, item = heapq.heappop(self.heap)
+            if self.counts.get(item) == count:
+                return count, item
+
+    def _rebuild(self):
+        """Rebuild the heap without the entries of outdated counts."""
+        self.heap = [(count, item) for item, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def add(self, item, count=1):
+        """Count the given item."""
+        if item in self.counts:
+            self.counts[item] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+        else:
+            minimum, evicted = self._pop()
+            del self.counts[evicted]
+            del self.errors[evicted]
+            self.counts[item] = minimum + count
+            self.errors[item] = minimum
+        heapq.heappush(self.heap, (self.counts[item], item))
+        if len(self.heap) > 4 * self.capacity:
+            self._rebuild()
+
+    def merge(self, other):
+        """Merge the counters of another sketch into this one.
+
+        Items missing in a full sketch might still have occurred up to its
+        minimum count, which is why that minimum is added as count and error
+        for them. Afterwards, only the items with the largest counts are kept
+        (see Cafaro et al. on mergeable Space-Saving summaries).
+
+        """
+        minima = [
+            min(sketch.counts.values())
+            if len(sketch.counts) >= sketch.capacity
+            else 0
+            for sketch
+            in [self, other]
+        ]
+        counts, errors = {}, {}
+        for item in set(self.counts) | set(other.counts):
+            counts[item] = errors[item] = 0
+            for sketch, minimum in zip([self, other], minima):
+                counts[item] += sketch.counts.get(item, minimum)
+                errors[item] += sketch.errors.get(item, minimum)
+        items = sorted(counts, key=lambda x: (-counts[x], x))[:self.capacity]
+        self.counts = {item: counts[item] for item in items}
+        self.errors = {item: errors[item] for item in items}
+        self._rebuild()
+
+    def top(self, k):
+        """Return the k most frequent items with their estimated counts."""
+        return sorted(
+            self.counts.items(),
+            key=lambda x: (-x[1], x[0]),
+        )[:k]
+
+
+class HyperLogLog:
+    """Estimates the number of distinct items of a stream in fixed memory.
+
+    This is the HyperLogLog algorithm by Flajolet et al. with the linear
+    counting correction for small cardinalities. Each item is hashed to 64
+    bits, the first `precision` bits select a register, and the register
+    keeps the maximum position of the first set bit in the remaining bits.
+    The standard error is about 1.04 / sqrt(2 ** precision), i.e. 0.8% for
+    the default precision at 16 KiB of registers. Registers of sketches with
+    the same precision can be merged by taking their elementwise maximum,
+    which is how partial sketches are combined.
+
+    """
+
+    def __init__(self, precision=14, registers=None):
+        """Initialize a sketch, optionally from serialized registers."""
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = (
+            bytearray(registers)
+            if registers is not None
+            else bytearray(self.m)
+        )
+        if len(self.registers) != self.m:
+            raise ValueError('invalid number of registers')
+
+    def add(self, item):
+        """Add the given string to the sketch."""
+        x = int.from_bytes(
+            hashlib.blake2b(item.encode(), digest_size=8).digest(),
+            byteorder='big',
+        )
+        index = x >> (64 - self.precision)
+        remainder = x & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remainder.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Merge the registers of another sketch into this one."""
+        if other.precision != self.precision:
+            raise ValueError('cannot merge sketches of different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self):
+        """Return the estimated number of distinct items added."""
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m**2 / sum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros > 0:
+            estimate = self.m * math.log(self.m / zeros)
+        return round(estimate)
+
+    def serialize(self):
+        """Return the registers as bytes, e.g. to be stored in the database."""
+        return bytes(self.registers)
+
+
+class BloomFilter:
+    """Tests whether an item was added before with a bounded error rate.
+
+    The filter sets `k` bits in a bit array of size `m` for every item, the
+    positions being derived from a single 128-bit hash by double hashing.
+    Items that were added are always found, other items are found with a
+    probability of about `error` as long as at most `capacity` items were
+    added. Both `m` and `k` are chosen optimally for capacity and error.
+
+    """
+
+    def __init__(self, capacity, error, bits=None, count=0):
+        """Initialize a filter, optionally from serialized bits."""
+        self.capacity = capacity
+        self.error = error
+        self.m = math.ceil(-capacity * math.log(error) / math.log(2)**2)
+        self.k = math.ceil(self.m / capacity * math.log(2))
+        self.bits = (
+            bytearray(bits)
+            if bits is not None
+            else bytearray((self.m + 7) // 8)
+        )
+        if len(self.bits) != (self.m + 7) // 8:
+            raise ValueError('invalid number of bits')
+        self.count = count
+
+    def _positions(self, item):
+        """Return the positions of the bits corresponding to the item."""
+        x = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(x[:8], byteorder='big')
+        h2 = int.from_bytes(x[8:], byteorder='big') | 1
+        return [(h1 + i * h2) % self.m for i in range(self.k)]
+
+    def __contains__(self, item):
+        """Check if the item was probably added to the filter before."""
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position
+            in self._positions(item)
+        )
+
+    def add(self, item):
+        """Add the given string to the filter."""
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def merge(self, bits, offset=0):
+        """Merge serialized bits into the filter, starting at the byte offset.
+
+        Merging is the union of the bits, such that partial filters of the
+        same capacity and error can be combined slice by slice.
+
+        """
+        end = offset + len(bits)
+        if end > len(self.bits):
+            raise ValueError('invalid number of bits')
+        union = (
+            int.from_bytes(self.bits[offset:end], byteorder='big')
+            | int.from_bytes(bits, byteorder='big')
+        )
+        self.bits[offset:end] = union.to_bytes(len(bits), byteorder='big')
+
+    def estimate(self):
+        """Return the estimated number of items from the number of set bits.
+
+        This is the estimate by Swamidass and Baldi, which is used to
+        recover the count of merged filters.
+
+        """
+        x = bin(int.from_bytes(self.bits, byteorder='big')).count('1')
+        if x >= self.m:
+            return self.capacity
+        return round(-self.m / self.k * math.log(1 - x / self.m))
+
+
+class ScalableBloomFilter:
+    """Bloom filter that grows with the number of added items.
+
+    This is the scalable Bloom filter by Almeida et al. The number of items
+    is not known in advance, so once a filter reaches its capacity, a new
+    filter with `growth` times the capacity and `ratio` times the error is
+    added. The error rates form a geometric series, such that the overall
+    error stays below `error` regardless of the number of added items.
+
+    """
+
+    def __init__(
+            self,
+            capacity=1000,
+            error=0.001,
+            growth=2,
+            ratio=0.5,
+            filters=None,
+    ):
+        """Initialize a filter, optionally from serialized filters."""
+        self.capacity = capacity
+        self.error = error
+        self.growth = growth
+        self.ratio = ratio
+        self.filters = [
+            BloomFilter(**bloom)
+            for bloom
+            in (filters or [])
+        ]
+
+    def __contains__(self, item):
+        """Check if the item was probably added to the filter before."""
+        return any(item in bloom for bloom in self.filters)
+
+    def add(self, item):
+        """Add the given string and return if it was probably new."""
+        if item in self:
+            return False
+        if not self.filters or (
+                self.filters[-1].count >= self.filters[-1].capacity
+        ):
+            self.grow()
+        self.filters[-1].add(item)
+        return True
+
+    def grow(self):
+        """Append and return an empty filter of the next capacity and error."""
+        n = len(self.filters)
+        self.filters.append(BloomFilter(
+            capacity=self.capacity * self.growth**n,
+            error=self.error * (1 - self.ratio) * self.ratio**n,
+        ))
+        return self.filters[-1]
+
+    def serialize(self):
+        """Return the filters as list, e.g. to be stored in the database."""
+        return [
+            {
+                'capacity': bloom.capacity,
+                'error': bloom.error,
+                'bits': bytes(bloom.bits),
+                'count': bloom.count,
+            }
+            for bloom
+            in self.filters
+        ]
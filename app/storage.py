@@ -0,0 +1,664 @@
+import copy
+import random
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from pymongo.results import (
+    InsertOneResult,
+    InsertManyResult,
+    UpdateResult,
+    DeleteResult,
+)
+
+
+def create(engine, connection_string=None, name=None):
+    """Create the storage engine of the given name."""
+    if engine == 'motor':
+        return MotorStorage(connection_string, name)
+    if engine == 'memory':
+        return MemoryStorage()
+    raise ValueError(f'unknown storage engine {engine}')
+
+
+class MotorStorage:
+    """Storage engine backed by a MongoDB database via motor.
+
+    All storage engines provide access to their collections by name, the
+    collections implementing the part of motor's collection interface that
+    the application uses, including aggregation pipelines that merge their
+    results into another collection.
+
+    """
+
+    def __init__(self, connection_string, name):
+        """Connect to the database of the given name."""
+        self.connection_string = connection_string
+        self.client = AsyncIOMotorClient(connection_string)
+        self.database = self.client[name]
+
+    def __getitem__(self, name):
+        """Return the collection of the given name."""
+        return self.database[name]
+
+    def synchronous(self):
+        """Return a blocking link to the database, e.g. to set up indices."""
+        return MongoClient(self.connection_string)[self.database.name]
+
+    async def drop(self):
+        """Delete all collections of the database."""
+        await self.client.drop_database(self.database.name)
+
+
+class MemoryStorage:
+    """Storage engine that keeps all collections in process memory.
+
+    The engine does not need a running MongoDB and is thus handy to
+    benchmark the application logic or to run a small single node
+    deployment. Data does not survive restarts, TTL indices do not expire
+    documents, and aggregation pipelines are limited to the stages and
+    expressions that the application uses.
+
+    """
+
+    def __init__(self):
+        """Initialize an empty storage."""
+        self.collections = {}
+
+    def __getitem__(self, name):
+        """Return the collection of the given name, creating it if needed."""
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name, self)
+        return self.collections[name]
+
+    def synchronous(self):
+        """Return a blocking link to the database, e.g. to set up indices."""
+        return _SynchronousMemoryStorage(self)
+
+    async def drop(self):
+        """Delete all collections of the database."""
+        self.collections.clear()
+
+
+class _SynchronousMemoryStorage:
+    """Blocking interface of the memory storage used at startup."""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getitem__(self, name):
+        return _SynchronousMemoryCollection(self.storage[name])
+
+
+class _SynchronousMemoryCollection:
+    """Blocking interface of a memory collection used at startup."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def create_index(self, keys, name=None, unique=False, **options):
+        return self.collection._index(keys, name, unique)
+
+    def find(self, filter=None, projection=None):
+        return [
+            _project(document, projection)
+            for document
+            in self.collection._find(filter)
+        ]
+
+
+def _resolve(document, path):
+    """Return the value at the dotted path, or None if it does not exist."""
+    value = document
+    for key in path.split('.'):
+        if type(value) is not dict or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def _contains(document, path):
+    """Check if the document has a value at the dotted path."""
+    value = document
+    for key in path.split('.'):
+        if type(value) is not dict or key not in value:
+            return False
+        value = value[key]
+    return True
+
+
+def _assign(document, path, value):
+    """Set the value at the dotted path, creating nested documents."""
+    *keys, last = path.split('.')
+    for key in keys:
+        document = document.setdefault(key, {})
+    document[last] = value
+
+
+def _remove(document, path):
+    """Delete the value at the dotted path if it exists."""
+    *keys, last = path.split('.')
+    for key in keys:
+        document = document.get(key)
+        if type(document) is not dict:
+            return
+    document.pop(last, None)
+
+
+def _compare(operator, value, operand):
+    """Evaluate a single query operator on a value."""
+    try:
+        if operator == '$eq':
+            return value == operand
+        if operator == '$ne':
+            return value != operand
+        if operator == '$in':
+            return value in operand
+        if operator == '$lt':
+            return value is not None and value < operand
+        if operator == '$lte':
+            return value is not None and value <= operand
+        if operator == '$gt':
+            return value is not None and value > operand
+        if operator == '$gte':
+            return value is not None and value >= operand
+    except TypeError:
+        return False
+    raise NotImplementedError(f'unsupported query operator {operator}')
+
+
+def _matches(document, expression):
+    """Check if the document matches the query expression."""
+    for key, condition in expression.items():
+        if key == '$or':
+            if not any(_matches(document, e) for e in condition):
+                return False
+        elif key == '$and':
+            if not all(_matches(document, e) for e in condition):
+                return False
+        elif type(condition) is dict and condition and all(
+                operator.startswith('$')
+                for operator
+                in condition.keys()
+            ):
+            value = _resolve(document, key)
+            for operator, operand in condition.items():
+                if operator == '$exists':
+                    if _contains(document, key) != operand:
+                        return False
+                elif not _compare(operator, value, operand):
+                    return False
+        elif _resolve(document, key) != condition:
+            return False
+    return True
+
+
+def _project(document, projection):
+    """Return a copy of the document restricted to the projection."""
+    document = copy.deepcopy(document)
+    if not projection:
+        return document
+    inclusions = [
+        path
+        for path, included
+        in projection.items()
+        if included and path != '_id'
+    ]
+    if inclusions:
+        result = {}
+        if projection.get('_id', True) and '_id' in document:
+            result['_id'] = document['_id']
+        for path in inclusions:
+            if _contains(document, path):
+                _assign(result, path, _resolve(document, path))
+        return result
+    for path, included in projection.items():
+        if not included:
+            _remove(document, path)
+    return document
+
+
+def _reshape(document, specification):
+    """Evaluate a `$project` stage that may compute new fields."""
+    if all(type(value) in [bool, int] for value in specification.values()):
+        return _project(document, specification)
+    result = {}
+    if specification.get('_id', True) and '_id' in document:
+        result['_id'] = document['_id']
+    for path, expression in specification.items():
+        if path == '_id':
+            continue
+        if expression is True or expression == 1:
+            if _contains(document, path):
+                _assign(result, path, _resolve(document, path))
+        else:
+            _assign(result, path, _evaluate(document, expression))
+    return result
+
+
+def _sort(documents, sort):
+    """Sort the documents in place by the list of keys and directions."""
+    for key, direction in reversed(sort or []):
+        documents.sort(
+            key=lambda document: (
+                _resolve(document, key) is not None,
+                _resolve(document, key),
+            ),
+            reverse=direction < 0,
+        )
+
+
+def _truthy(value):
+    """Check if the value is true in the sense of aggregation expressions."""
+    return not (
+        value is None
+        or value is False
+        or (type(value) in [int, float] and value == 0)
+    )
+
+
+def _evaluate(document, expression):
+    """Evaluate an aggregation expression on the document."""
+    if type(expression) is str and expression.startswith('$'):
+        return _resolve(document, expression[1:])
+    if type(expression) is not dict:
+        return expression
+    (operator, operand), = expression.items()
+    if operator == '$toInt':
+        value = _evaluate(document, operand)
+        return None if value is None else int(value)
+    if operator == '$and':
+        return all(_truthy(_evaluate(document, e)) for e in operand)
+    if operator == '$cond':
+        condition, then, otherwise = operand
+        return _evaluate(
+            document,
+            then if _truthy(_evaluate(document, condition)) else otherwise,
+        )
+    raise NotImplementedError(f'unsupported expression operator {operator}')
+
+
+def _group(documents, specification):
+    """Evaluate a `$group` stage with a constant identifier and sums."""
+    specification = dict(specification)
+    identifier = specification.pop('_id')
+    if type(identifier) is str and identifier.startswith('$'):
+        raise NotImplementedError('unsupported group identifier')
+    if not documents:
+        return []
+    result = {'_id': identifier}
+    for key, accumulator in specification.items():
+        (operator, expression), = accumulator.items()
+        if operator != '$sum':
+            raise NotImplementedError(f'unsupported accumulator {operator}')
+        result[key] = 0
+        for document in documents:
+            value = _evaluate(document, expression)
+            if type(value) in [int, float]:
+                result[key] += value
+    return [result]
+
+
+def _update(document, update, insert=False):
+    """Apply the update operators to the document in place."""
+    for operator, fields in update.items():
+        if operator == '$set':
+            for path, value in fields.items():
+                _assign(document, path, copy.deepcopy(value))
+        elif operator == '$inc':
+            for path, value in fields.items():
+                value += _resolve(document, path) or 0
+                _assign(document, path, value)
+        elif operator == '$setOnInsert':
+            if insert:
+                for path, value in fields.items():
+                    _assign(document, path, copy.deepcopy(value))
+        else:
+            raise NotImplementedError(f'unsupported operator {operator}')
+
+
+class MemoryCursor:
+    """Cursor over the results of a query on a memory collection."""
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.documents:
+            yield document
+
+    async def to_list(self, length):
+        """Return at most length documents, or all if length is None."""
+        if length is None:
+            return list(self.documents)
+        return self.documents[:length]
+
+
+class MemoryCollection:
+    """Collection of the memory storage mirroring motor's interface."""
+
+    def __init__(self, name, storage=None):
+        """Initialize an empty collection of the given storage."""
+        self.name = name
+        self.storage = storage
+        self.documents = {}
+        self.indexes = {}
+
+    def _index(self, keys, name=None, unique=False):
+        """Register an index, of which only unique ones are enforced."""
+        if type(keys) is str:
+            keys = [(keys, 1)]
+        if name is None:
+            name = '_'.join(f'{key}_{direction}' for key, direction in keys)
+        if unique:
+            keys = [key for key, _ in keys]
+            self.indexes[name] = keys, {
+                self._key(document, keys): document['_id']
+                for document
+                in self.documents.values()
+            }
+        return name
+
+    @staticmethod
+    def _key(document, keys):
+        """Return the hashable index entry of the document."""
+        return repr(tuple(_resolve(document, key) for key in keys))
+
+    def _check(self, document, ignore=None):
+        """Raise if the document violates the collection's unique indices."""
+        if document['_id'] in self.documents and document['_id'] != ignore:
+            raise DuplicateKeyError('duplicate key error on _id', 11000)
+        for name, (keys, entries) in self.indexes.items():
+            identifier = entries.get(self._key(document, keys), ignore)
+            if identifier != ignore:
+                raise DuplicateKeyError(
+                    f'duplicate key error on index {name}',
+                    11000,
+                )
+
+    def _store(self, document):
+        """Store the document and add it to the unique indices."""
+        self.documents[document['_id']] = document
+        for keys, entries in self.indexes.values():
+            entries[self._key(document, keys)] = document['_id']
+
+    def _unstore(self, document):
+        """Delete the document and remove it from the unique indices."""
+        del self.documents[document['_id']]
+        for keys, entries in self.indexes.values():
+            entries.pop(self._key(document, keys), None)
+
+    def _find(self, expression, sort=None):
+        """Return the stored documents matching the query expression."""
+        expression = expression or {}
+        identifier = expression.get('_id')
+        if identifier is not None and type(identifier) is not dict:
+            document = self.documents.get(identifier)
+            if document is None or not _matches(document, expression):
+                return []
+            return [document]
+        documents = [
+            document
+            for document
+            in self.documents.values()
+            if _matches(document, expression)
+        ]
+        _sort(documents, sort)
+        return documents
+
+    def _upsert(self, expression, update=None, replacement=None):
+        """Insert the document that an upsert with no match creates."""
+        document = {
+            key: copy.deepcopy(value)
+            for key, value
+            in expression.items()
+            if not key.startswith('$') and type(value) is not dict
+        }
+        if replacement is not None:
+            document.update(copy.deepcopy(replacement))
+        if update is not None:
+            _update(document, update, insert=True)
+        document.setdefault('_id', ObjectId())
+        self._check(document)
+        self._store(document)
+        return document
+
+    def _replace(self, document, replacement):
+        """Replace the stored document while keeping its identifier."""
+        replacement = copy.deepcopy(replacement)
+        replacement['_id'] = document['_id']
+        self._check(replacement, ignore=document['_id'])
+        self._unstore(document)
+        self._store(replacement)
+        return replacement
+
+    async def create_index(self, keys, name=None, unique=False, **options):
+        """Register an index, of which only unique ones are enforced."""
+        return self._index(keys, name, unique)
+
+    async def find_one(self, filter=None, projection=None, sort=None):
+        """Return the first document matching the filter or None."""
+        documents = self._find(filter, sort)
+        return _project(documents[0], projection) if documents else None
+
+    def find(
+            self,
+            filter=None,
+            projection=None,
+            sort=None,
+            limit=0,
+            batch_size=None,
+    ):
+        """Return a cursor over the documents matching the filter."""
+        documents = self._find(filter, sort)
+        if limit:
+            documents = documents[:limit]
+        return MemoryCursor([
+            _project(document, projection)
+            for document
+            in documents
+        ])
+
+    async def count_documents(self, filter):
+        """Return the number of documents matching the filter."""
+        return len(self._find(filter))
+
+    async def estimated_document_count(self):
+        """Return the number of documents in the collection."""
+        return len(self.documents)
+
+    async def insert_one(self, document):
+        """Insert a document, adding an identifier if it has none."""
+        document.setdefault('_id', ObjectId())
+        self._check(document)
+        self._store(copy.deepcopy(document))
+        return InsertOneResult(document['_id'], True)
+
+    async def insert_many(self, documents, ordered=True):
+        """Insert documents, reporting duplicates like a bulk write."""
+        errors = []
+        identifiers = []
+        for index, document in enumerate(documents):
+            try:
+                await self.insert_one(document)
+                identifiers.append(document['_id'])
+            except DuplicateKeyError as error:
+                errors.append({
+                    'index': index,
+                    'code': 11000,
+                    'errmsg': str(error),
+                    'op': document,
+                })
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({
+                'writeErrors': errors,
+                'writeConcernErrors': [],
+                'nInserted': len(identifiers),
+                'nUpserted': 0,
+                'nMatched': 0,
+                'nModified': 0,
+                'nRemoved': 0,
+                'upserted': [],
+            })
+        return InsertManyResult(identifiers, True)
+
+    async def replace_one(self, filter, replacement, upsert=False):
+        """Replace the first document matching the filter."""
+        documents = self._find(filter)
+        if documents:
+            self._replace(documents[0], replacement)
+            return UpdateResult({'n': 1, 'nModified': 1}, True)
+        if upsert:
+            document = self._upsert(filter, replacement=replacement)
+            return UpdateResult({'n': 1, 'upserted': document['_id']}, True)
+        return UpdateResult({'n': 0, 'nModified': 0}, True)
+
+    async def _update_documents(self, filter, update, upsert, many):
+        """Update the first or all documents matching the filter."""
+        documents = self._find(filter)
+        if not many:
+            documents = documents[:1]
+        for document in documents:
+            updated = copy.deepcopy(document)
+            _update(updated, update)
+            self._replace(document, updated)
+        if not documents and upsert:
+            document = self._upsert(filter, update=update)
+            return UpdateResult({'n': 1, 'upserted': document['_id']}, True)
+        n = len(documents)
+        return UpdateResult({'n': n, 'nModified': n}, True)
+
+    async def update_one(self, filter, update, upsert=False):
+        """Update the first document matching the filter."""
+        return await self._update_documents(filter, update, upsert, False)
+
+    async def update_many(self, filter, update, upsert=False):
+        """Update all documents matching the filter."""
+        return await self._update_documents(filter, update, upsert, True)
+
+    async def find_one_and_update(
+            self,
+            filter,
+            update,
+            projection=None,
+            upsert=False,
+            return_document=ReturnDocument.BEFORE,
+    ):
+        """Update the first matching document and return it."""
+        documents = self._find(filter)
+        if documents:
+            updated = copy.deepcopy(documents[0])
+            _update(updated, update)
+            updated = self._replace(documents[0], updated)
+            if return_document == ReturnDocument.AFTER:
+                return _project(updated, projection)
+            return _project(documents[0], projection)
+        if upsert:
+            document = self._upsert(filter, update=update)
+            if return_document == ReturnDocument.AFTER:
+                return _project(document, projection)
+        return None
+
+    async def find_one_and_replace(
+            self,
+            filter,
+            replacement,
+            projection=None,
+            upsert=False,
+            return_document=ReturnDocument.BEFORE,
+    ):
+        """Replace the first matching document and return it."""
+        documents = self._find(filter)
+        if documents:
+            replaced = self._replace(documents[0], replacement)
+            if return_document == ReturnDocument.AFTER:
+                return _project(replaced, projection)
+            return _project(documents[0], projection)
+        if upsert:
+            document = self._upsert(filter, replacement=replacement)
+            if return_document == ReturnDocument.AFTER:
+                return _project(document, projection)
+        return None
+
+    async def delete_one(self, filter):
+        """Delete the first document matching the filter."""
+        documents = self._find(filter)[:1]
+        for document in documents:
+            self._unstore(document)
+        return DeleteResult({'n': len(documents)}, True)
+
+    async def delete_many(self, filter):
+        """Delete all documents matching the filter."""
+        documents = self._find(filter)
+        for document in documents:
+            self._unstore(document)
+        return DeleteResult({'n': len(documents)}, True)
+
+    async def drop(self):
+        """Delete all documents and indices of the collection."""
+        self.documents.clear()
+        self.indexes.clear()
+
+    def _merge(self, documents, specification):
+        """Replace or insert the documents into the target collection."""
+        if (
+                specification.get('on', '_id') != '_id'
+                or specification.get('whenMatched') != 'replace'
+                or specification.get('whenNotMatched') != 'insert'
+        ):
+            raise NotImplementedError('unsupported merge specification')
+        target = self.storage[specification['into']]
+        for document in documents:
+            matches = target._find({'_id': document['_id']})
+            if matches:
+                target._replace(matches[0], document)
+            else:
+                target._check(document)
+                target._store(copy.deepcopy(document))
+
+    def aggregate(self, pipeline, **options):
+        """Run the aggregation pipeline and return a cursor over its output.
+
+        Only the stages and expressions that the application uses are
+        supported, i.e. `$match`, `$project`, `$sample`, `$sort`, `$merge`,
+        and `$group` with a constant identifier and sums.
+
+        """
+        documents = list(self.documents.values())
+        for stage in pipeline:
+            (operator, specification), = stage.items()
+            if operator == '$match':
+                documents = [
+                    document
+                    for document
+                    in documents
+                    if _matches(document, specification)
+                ]
+            elif operator == '$project':
+                documents = [
+                    _reshape(document, specification)
+                    for document
+                    in documents
+                ]
+            elif operator == '$sample':
+                documents = random.sample(
+                    documents,
+                    min(specification['size'], len(documents)),
+                )
+            elif operator == '$sort':
+                documents = list(documents)
+                _sort(documents, list(specification.items()))
+            elif operator == '$group':
+                documents = _group(documents, specification)
+            elif operator == '$merge':
+                self._merge(documents, specification)
+                documents = []
+            else:
+                raise NotImplementedError(f'unsupported stage {operator}')
+        return MemoryCursor([copy.deepcopy(d) for d in documents])
@@ -1,24 +1,58 @@
 import secrets
 import os
+import sys
 import asyncio
+import hashlib
+import logging
+
+import orjson
 
 from fastapi import HTTPException
-from starlette.responses import RedirectResponse
-from pymongo.errors import DuplicateKeyError
+from starlette.responses import RedirectResponse, Response
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from cachetools import LRUCache
 
 from app.validation import SubmissionValidator, ConfigurationValidator
-from app.aggregation import Alligator
-from app.utils import combine, now
+from app.aggregation import Alligator, Histogram
+from app.utils import combine, now, digest, matches
+from app.caching import SurveyCache, sizeof
+from app.admission import AdmissionController
+from app.deduplication import DuplicateGuard
+from app.idempotency import IdempotencyManager, commit
+from app.tracing import span, traced
+
+
+logger = logging.getLogger(__name__)
 
 
 # frontend url
 FRONTEND_URL = os.getenv('FRONTEND_URL')
+# maximum memory in bytes that cached surveys may occupy
+SURVEY_CACHE_SIZE = int(os.getenv('SURVEY_CACHE_SIZE', 64 * 2**20))
+# optional time in seconds after which cached surveys expire
+SURVEY_CACHE_TTL = (
+    float(os.getenv('SURVEY_CACHE_TTL'))
+    if os.getenv('SURVEY_CACHE_TTL')
+    else None
+)
+# maximum number of concurrently processed submissions per survey
+SUBMISSION_CONCURRENCY = int(os.getenv('SUBMISSION_CONCURRENCY', 16))
+# maximum number of submissions per survey waiting to be processed
+SUBMISSION_QUEUE = int(os.getenv('SUBMISSION_QUEUE', 64))
+# reject repeated identical submissions to open surveys that opt in
+DUPLICATE_GUARD = os.getenv('DUPLICATE_GUARD') == 'true'
+# preload currently open surveys into the cache when the server starts
+SURVEY_CACHE_WARMUP = os.getenv('SURVEY_CACHE_WARMUP') == 'true'
+# seconds for which clients may reuse results without revalidating them
+RESULTS_MAX_AGE = int(os.getenv('RESULTS_MAX_AGE', 60))
 
 
 class SurveyManager:
     """The manager manages creating, updating and deleting surveys."""
 
+    # maximum number of surveys that are warmed up concurrently
+    WARMUP_CONCURRENCY = 8
 
     # TODO make distinction between frontend/backend configuration format
     # clearer, e.g. move exception handling into public functions and give
@@ -30,31 +64,140 @@ class SurveyManager:
         """Initialize a survey manager instance."""
         self.database = database
         self.letterbox = letterbox
-        self.cache = LRUCache(maxsize=256)
+        self.cache = SurveyCache(SURVEY_CACHE_SIZE, SURVEY_CACHE_TTL)
+        self.resultss = LRUCache(maxsize=1024)
+        self.admission = AdmissionController(
+            SUBMISSION_CONCURRENCY,
+            SUBMISSION_QUEUE,
+        )
+        self.guard = DuplicateGuard(database) if DUPLICATE_GUARD else None
+        self.idempotency = IdempotencyManager(database)
         self.validator = ConfigurationValidator.create()
         self.token_manager = token_manager
+        self.warmup = None
 
     def _update_cache(self, configuration):
-        """Update survey object in the local cache."""
+        """Update survey object in the local cache and return it.
+
+        Surveys that are larger than the whole cache are not cached at all,
+        but are still returned to be used for the current request.
+
+        """
         survey_id = combine(
             configuration['username'],
             configuration['survey_name'],
         )
-        self.cache[survey_id] = Survey(
+        survey = Survey(
             configuration,
             self.database,
             self.letterbox,
+            self.resultss,
+            self.guard,
+            self.cache,
+        )
+        try:
+            self.cache[survey_id] = survey
+        except ValueError:
+            self.cache.pop(survey_id, None)
+        return survey
+
+    def start(self):
+        """Start warming the survey cache in the background if enabled."""
+        if SURVEY_CACHE_WARMUP:
+            self.warmup = asyncio.create_task(self._warm())
+
+    async def stop(self):
+        """Stop warming the survey cache if it is still in progress."""
+        if self.warmup is not None:
+            self.warmup.cancel()
+            try:
+                await self.warmup
+            except asyncio.CancelledError:
+                pass
+            self.warmup = None
+
+    async def _warm(self):
+        """Warm the survey cache, logging instead of raising failures."""
+        try:
+            await self.warm()
+        except Exception:
+            logger.exception('survey cache warm-up failed')
+
+    @traced('SurveyManager.warm')
+    async def warm(self):
+        """Preload currently open surveys into the cache.
+
+        After a deploy, every worker starts with an empty cache, such that
+        the first request to each live survey would pay for fetching the
+        configuration and compiling its validator, and, with duplicate
+        detection, for loading the survey's duplicate filter. Open surveys
+        are prepared concurrently, most recently started first, until the
+        cache budget is exhausted. Surveys already cached by requests in the
+        meantime are left as they are, and every survey yields to the event
+        loop, such that requests are served concurrently to the warm-up.
+
+        """
+        timestamp = now()
+        cursor = self.database['configurations'].find(
+            filter={'start': {'$lte': timestamp}, 'end': {'$gt': timestamp}},
+            projection={'_id': False},
+            sort=[('start', DESCENDING)],
         )
+        configurations = await cursor.to_list(None)
+        semaphore = asyncio.Semaphore(self.WARMUP_CONCURRENCY)
+        exhausted = False
+
+        async def _warm(configuration):
+            """Cache a single survey once the semaphore admits it."""
+            nonlocal exhausted
+            async with semaphore:
+                survey_id = combine(
+                    configuration['username'],
+                    configuration['survey_name'],
+                )
+                if exhausted or survey_id in self.cache:
+                    return
+                survey = Survey(
+                    configuration,
+                    self.database,
+                    self.letterbox,
+                    self.resultss,
+                    self.guard,
+                    self.cache,
+                )
+                survey.compile()
+                if self.cache.currsize + survey.size > self.cache.maxsize:
+                    exhausted = True
+                    return
+                self.cache[survey_id] = survey
+                if survey.guard is not None:
+                    await survey.guard.load(survey_id)
+                await asyncio.sleep(0)
+
+        await asyncio.gather(*[
+            _warm(configuration)
+            for configuration
+            in configurations
+        ])
+
+    async def fetch(self, username, survey_name, if_none_match=None):
+        """Return survey configuration corresponding to user/survey name.
+
+        Clients are asked to revalidate the configuration on every use, which
+        is cheap as unchanged configurations are answered with a bodiless
+        304 response based on the configuration's ETag. Otherwise, we return
+        the configuration that the cached survey holds already serialized.
 
-    async def fetch(self, username, survey_name):
-        """Return survey configuration corresponding to user/survey name."""
+        """
         survey = await self._fetch(username, survey_name)
-        return {
-            key: survey.configuration[key]
-            for key
-            in survey.configuration.keys()
-            if key not in ['username']
-        }
+        headers = {'ETag': survey.etag, 'Cache-Control': 'no-cache'}
+        if matches(if_none_match, survey.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(
+            content=survey.dump,
+            media_type='application/json',
+            headers=headers,
+        )
 
     async def create(
             self,
@@ -78,6 +221,93 @@ class SurveyManager:
         self.token_manager.authorize(username, access_token)
         await self._update(username, survey_name, configuration)
 
+    async def invite(
+            self,
+            username,
+            survey_name,
+            email_addresses,
+            access_token,
+        ):
+        """Issue invitation tokens for the given list of email addresses."""
+        self.token_manager.authorize(username, access_token)
+        survey = await self._fetch(username, survey_name)
+        return await survey.invite(email_addresses)
+
+    async def submit(
+            self,
+            username,
+            survey_name,
+            request,
+            token=None,
+            idempotency_key=None,
+    ):
+        """Read, validate and store a submission once the survey admits it.
+
+        The body is read before the submission claims its idempotency key
+        and an admission slot, such that slow or oversized uploads hold
+        neither while they are being received.
+
+        """
+        survey_id = combine(username, survey_name)
+        survey = await self._fetch(username, survey_name)
+        submission = await survey.receive(request)
+        hint = (
+            request.client.host if request.client else None,
+            request.headers.get('user-agent'),
+        )
+
+        async def _submit():
+            """Process the submission, at most once per idempotency key."""
+            async with self.admission.admit(survey_id):
+                return await survey.submit(submission, token, hint)
+
+        return await self.idempotency.execute(
+            f'{survey_id}.submission',
+            idempotency_key,
+            _submit,
+        )
+
+    async def verify(
+            self,
+            username,
+            survey_name,
+            verification_token,
+            idempotency_key=None,
+    ):
+        """Verify a submission's email address once the survey admits it."""
+        survey_id = combine(username, survey_name)
+
+        async def _verify():
+            """Process the verification, at most once per idempotency key."""
+            async with self.admission.admit(survey_id):
+                survey = await self._fetch(username, survey_name)
+                return await survey.verify(verification_token)
+
+        return await self.idempotency.execute(
+            f'{survey_id}.verification',
+            idempotency_key,
+            _verify,
+        )
+
+    async def fetch_histogram(self, username, survey_name, access_token):
+        """Return the submission counts of a survey per time bucket."""
+        self.token_manager.authorize(username, access_token)
+        survey = await self._fetch(username, survey_name)
+        return await survey.histogram.fetch()
+
+    async def fetch_crosstab(
+            self,
+            username,
+            survey_name,
+            row,
+            column,
+            access_token,
+        ):
+        """Return the joint answer counts of two fields of a survey."""
+        self.token_manager.authorize(username, access_token)
+        survey = await self._fetch(username, survey_name)
+        return await survey.crosstab(row, column)
+
     async def reset(self, username, survey_name, access_token):
         """Delete all submission data including the results of a survey."""
         self.token_manager.authorize(username, access_token)
@@ -88,18 +318,19 @@ class SurveyManager:
         self.token_manager.authorize(username, access_token)
         await self._delete(username, survey_name)
 
+    @traced('SurveyManager._fetch')
     async def _fetch(self, username, survey_name):
         """Return the survey object corresponding to user and survey name."""
-        survey_id = combine(username, survey_name)
-        if survey_id not in self.cache:
+        survey = self.cache.get(combine(username, survey_name))
+        if survey is None:
             configuration = await self.database['configurations'].find_one(
                 filter={'username': username, 'survey_name': survey_name},
                 projection={'_id': False},
             )
             if configuration is None:
                 raise HTTPException(404, 'survey not found')
-            self._update_cache(configuration)
-        return self.cache[survey_id]
+            survey = self._update_cache(configuration)
+        return survey
 
     async def _create(self, username, survey_name, configuration):
         """Create a new survey configuration in the database and cache.
@@ -111,7 +342,9 @@ class SurveyManager:
         """
         if survey_name != configuration['survey_name']:
             raise HTTPException(400, 'invalid configuration')
-        if not self.validator.validate(configuration):
+        with span('ConfigurationValidator.validate'):
+            valid = self.validator.validate(configuration)
+        if not valid:
             raise HTTPException(400, 'invalid configuration')
         configuration['username'] = username
         try:
@@ -120,6 +353,7 @@ class SurveyManager:
             self._update_cache(configuration)
         except DuplicateKeyError:
             raise HTTPException(400, 'survey exists')
+        await self._index(configuration)
 
     async def _update(self, username, survey_name, configuration):
         """Update a survey configuration in the database and cache.
@@ -132,7 +366,9 @@ class SurveyManager:
 
         # TODO make update only possible if survey has not yet started
 
-        if not self.validator.validate(configuration):
+        with span('ConfigurationValidator.validate'):
+            valid = self.validator.validate(configuration)
+        if not valid:
             raise HTTPException(400, 'invalid configuration')
         configuration['username'] = username
         result = await self.database['configurations'].replace_one(
@@ -146,53 +382,167 @@ class SurveyManager:
         assert '_id' in configuration.keys()
 
         self._update_cache(configuration)
+        await self._index(configuration)
+
+    async def _index(self, configuration):
+        """Set up the database indices of the survey's collections.
+
+        The indices of existing surveys are set up together with the other
+        indices when the server starts, such that this is only needed once
+        when a survey is created or updated.
+
+        """
+        if configuration['authentication'] == 'invitation':
+            survey_id = combine(
+                configuration['username'],
+                configuration['survey_name'],
+            )
+            invitations = self.database[f'surveys.{survey_id}.invitations']
+            await invitations.create_index(
+                keys='email_address',
+                name='email_address_index',
+                unique=True,
+            )
 
     async def _archive(self, username, survey_name):
         """Delete submission data of a survey, but keep the results."""
         survey_id = combine(username, survey_name)
-        await self.database[f'surveys.{survey_id}.submissions'].drop()
-        await self.database[f'surveys.{survey_id}.verified-submissions'].drop()
+        await asyncio.gather(
+            self.database[f'surveys.{survey_id}.submissions'].drop(),
+            self.database[f'surveys.{survey_id}.verified-submissions'].drop(),
+        )
 
     async def _reset(self, username, survey_name):
-        """Delete all submission data including the results of a survey."""
+        """Delete all submission data including the results of a survey.
+
+        The individual deletions are independent of each other, which is why
+        we run them concurrently instead of waiting for each round trip.
+
+        """
         survey_id = combine(username, survey_name)
-        await self.database['results'].delete_one({'_id': survey_id})
-        await self.database[f'surveys.{survey_id}.submissions'].drop()
-        await self.database[f'surveys.{survey_id}.verified-submissions'].drop()
+        await asyncio.gather(
+            self.database['resultss'].delete_one({'_id': survey_id}),
+            self.database['histograms'].delete_many({'survey_id': survey_id}),
+            self.database['materializations'].delete_one({'_id': survey_id}),
+            self.database[f'surveys.{survey_id}.submissions'].drop(),
+            self.database[f'surveys.{survey_id}.verified-submissions'].drop(),
+            self.database[f'surveys.{survey_id}.invitations'].update_many(
+                filter={'used': True},
+                update={'$set': {'used': False}},
+            ),
+            self.database['versions'].update_one(
+                filter={'_id': survey_id},
+                update={'$inc': {'version': 1}},
+                upsert=True,
+            ),
+        )
+        if self.guard is not None:
+            await self.guard.discard(survey_id)
 
     async def _delete(self, username, survey_name):
         """Delete the survey and all its data from the database and cache."""
-        await self.database['configurations'].delete_one(
-            filter={'username': username, 'survey_name': survey_name},
-        )
         survey_id = combine(username, survey_name)
         if survey_id in self.cache:
             del self.cache[survey_id]
-        await self.database['results'].delete_one({'_id': survey_id})
-        await self.database[f'surveys.{survey_id}.submissions'].drop()
-        await self.database[f'surveys.{survey_id}.verified-submissions'].drop()
+        await asyncio.gather(
+            self.database['configurations'].delete_one(
+                filter={'username': username, 'survey_name': survey_name},
+            ),
+            self.database['resultss'].delete_one({'_id': survey_id}),
+            self.database['histograms'].delete_many({'survey_id': survey_id}),
+            self.database['materializations'].delete_one({'_id': survey_id}),
+            self.database[f'surveys.{survey_id}.submissions'].drop(),
+            self.database[f'surveys.{survey_id}.verified-submissions'].drop(),
+            self.database[f'surveys.{survey_id}.invitations'].drop(),
+            self.database['versions'].update_one(
+                filter={'_id': survey_id},
+                update={'$inc': {'version': 1}},
+                upsert=True,
+            ),
+        )
+        if self.guard is not None:
+            await self.guard.discard(survey_id)
 
 
 class Survey:
-    """The survey class that all surveys instantiate."""
+    """The survey class that all surveys instantiate.
+
+    Survey objects are held in the survey cache, which is bounded by the
+    memory that its surveys occupy. We therefore declare slots and compile
+    the submission validator and the aggregation pipelines only once they
+    are first needed, e.g. surveys that are only fetched by respondents
+    never need their aggregation pipelines.
+
+    """
+
+    __slots__ = (
+        'configuration',
+        'dump',
+        'etag',
+        'username',
+        'survey_name',
+        'start',
+        'end',
+        'authentication',
+        'ei',
+        'max_body_size',
+        'letterbox',
+        'database',
+        'resultss',
+        'guard',
+        'cache',
+        'histogram',
+        'submissions',
+        'verified_submissions',
+        'invitations',
+        'size',
+        '_validator',
+        '_alligator',
+    )
 
     def __init__(
             self,
             configuration,
             database,
             letterbox,
+            resultss=None,
+            guard=None,
+            cache=None,
     ):
-        """Create a survey from the given json configuration file."""
+        """Create a survey from the given json configuration file.
+
+        If the survey is held in the given survey cache, it updates its size
+        there when it builds its lazy members.
+
+        """
         self.configuration = configuration
+        self.dump = orjson.dumps({
+            key: value
+            for key, value
+            in self.configuration.items()
+            if key not in ['username']
+        })
+        self.etag = f'"{hashlib.sha256(self.dump).hexdigest()[:32]}"'
         self.username = self.configuration['username']
         self.survey_name = self.configuration['survey_name']
         self.start = self.configuration['start']
         self.end = self.configuration['end']
         self.authentication = self.configuration['authentication']
         self.ei = Survey._get_email_field_index(self.configuration)
-        self.validator = SubmissionValidator.create(self.configuration)
+        self.max_body_size = Survey._get_max_body_size(self.configuration)
         self.letterbox = letterbox
-        self.alligator = Alligator(self.configuration, database)
+        self.database = database
+        self.resultss = resultss
+        self.guard = (
+            guard
+            if self.authentication == 'open'
+            and self.configuration.get('deduplicate', False)
+            else None
+        )
+        self.cache = cache
+        self._validator = None
+        self._alligator = None
+        self.histogram = Histogram(self.configuration, database)
         self.submissions = database[
             f'surveys'
             f'.{combine(self.username, self.survey_name)}'
@@ -201,9 +551,69 @@ class Survey:
         self.verified_submissions = database[
             f'surveys'
             f'.{combine(self.username, self.survey_name)}'
-            f'.submissions.verified'
+            f'.verified-submissions'
         ]
-        self.results = None
+        self.invitations = database[
+            f'surveys'
+            f'.{combine(self.username, self.survey_name)}'
+            f'.invitations'
+        ]
+        self.size = self._sizeof()
+
+    def _sizeof(self):
+        """Estimate the memory that the survey occupies in bytes.
+
+        Lazy members are included once they are built. Parts that are shared
+        between surveys, e.g. the compiled validation schema or the compiled
+        pipeline parts, are not.
+
+        """
+        size = (
+            sys.getsizeof(self)
+            + sizeof(self.configuration)
+            + sys.getsizeof(self.dump)
+        )
+        if self._validator is not None:
+            size += (
+                sys.getsizeof(self._validator)
+                + sys.getsizeof(vars(self._validator))
+            )
+        if self._alligator is not None:
+            size += (
+                sys.getsizeof(self._alligator)
+                + sys.getsizeof(vars(self._alligator))
+            )
+        return size
+
+    def _resize(self):
+        """Update the survey's size, also in the cache that holds it."""
+        self.size = self._sizeof()
+        if self.cache is not None:
+            self.cache.resize(combine(self.username, self.survey_name), self)
+
+    def compile(self):
+        """Create the submission validator unless it already exists."""
+        if self._validator is None:
+            self._validator = SubmissionValidator.create(self.configuration)
+            self._resize()
+
+    @property
+    def validator(self):
+        """Return the submission validator, creating it on first use."""
+        self.compile()
+        return self._validator
+
+    @property
+    def alligator(self):
+        """Return the survey's aggregator, creating it on first use."""
+        if self._alligator is None:
+            self._alligator = Alligator(
+                configuration=self.configuration,
+                database=self.database,
+                cache=self.resultss,
+            )
+            self._resize()
+        return self._alligator
 
     @staticmethod
     def _get_email_field_index(configuration):
@@ -213,26 +623,143 @@ class Survey:
                 return index
         return None
 
-    async def submit(self, submission):
-        """Save a user submission in the submissions collection."""
+    @staticmethod
+    def _get_max_body_size(configuration):
+        """Compute the maximum size in bytes of a valid submission body.
+
+        The bound is generous: every character of a text may be escaped to
+        twelve bytes, and every field gets some slack for its key and for
+        whitespace and punctuation. Submissions are thus only rejected by
+        their size when they would be invalid anyway.
+
+        """
+        size = 1024
+        for field in configuration['fields']:
+            if field['type'] == 'email':
+                size += 64 + 12 * 320
+            if field['type'] == 'option':
+                size += 64
+            if field['type'] in ['radio', 'selection']:
+                size += 64 * (len(field['fields']) + 1)
+            if field['type'] == 'text':
+                size += 64 + 12 * field['max_chars']
+        return size
+
+    async def receive(self, request):
+        """Read and parse a submission while enforcing its maximum size.
+
+        The body is streamed and the request rejected as soon as it exceeds
+        the maximum size of a valid submission, such that oversized bodies
+        are neither completely buffered nor parsed.
+
+        """
+        content_length = request.headers.get('content-length')
+        if content_length is not None:
+            try:
+                content_length = int(content_length)
+            except ValueError:
+                raise HTTPException(400, 'invalid content length')
+            if content_length > self.max_body_size:
+                raise HTTPException(413, 'submission too large')
+        body = bytearray()
+        async for chunk in request.stream():
+            body += chunk
+            if len(body) > self.max_body_size:
+                raise HTTPException(413, 'submission too large')
+        try:
+            submission = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            raise HTTPException(400, 'invalid submission')
+        if type(submission) is not dict:
+            raise HTTPException(400, 'invalid submission')
+        return submission
+
+    async def invite(self, email_addresses):
+        """Issue one-time submission tokens for the given email addresses.
+
+        Only the sha256 hashes of the tokens are stored, the tokens themselves
+        are returned once to the survey owner. As the tokens are random and
+        long, a fast hash is sufficient here, which is what keeps issuing
+        tokens for some hundred thousand recipients in the range of seconds.
+        Addresses that were already invited before are skipped, such that
+        the owner can safely upload an extended recipient list again. The
+        insert is unordered, so if some invitations fail to be written, the
+        tokens of the others are still returned and the failed addresses are
+        issued tokens when the list is uploaded again.
+
+        """
+        if self.authentication != 'invitation':
+            raise HTTPException(400, 'survey does not use invitations')
+        if now() >= self.end:
+            raise HTTPException(400, 'survey is closed')
+        tokens = {
+            email_address: secrets.token_hex(32)
+            for email_address
+            in email_addresses
+        }
+        if not tokens:
+            return tokens
+        invitations = [
+            {
+                '_id': digest(token),
+                'email_address': email_address,
+                'used': False,
+            }
+            for email_address, token
+            in tokens.items()
+        ]
+        try:
+            await self.invitations.insert_many(invitations, ordered=False)
+        except BulkWriteError as error:
+            errors = error.details['writeErrors']
+            for e in errors:
+                del tokens[invitations[e['index']]['email_address']]
+            if error.details['nInserted'] != len(tokens):
+                raise HTTPException(500, 'invitation error')
+            if not tokens and any(e['code'] != 11000 for e in errors):
+                raise HTTPException(500, 'invitation error')
+        return tokens
+
+    @traced('Survey.submit')
+    async def submit(self, submission, token=None, hint=None):
+        """Save a user submission in the submissions collection.
+
+        Submissions to open surveys that opted into deduplication are
+        checked against the duplicate guard, using the hint to distinguish
+        between clients. The fingerprint is only added once the submission
+        is stored, such that failed submissions can be retried. Identical
+        submissions that are processed concurrently might thus both pass.
+
+        """
         submission_time = now()
         if submission_time < self.start:
             raise HTTPException(400, 'survey is not open yet')
         if submission_time >= self.end:
             raise HTTPException(400, 'survey is closed')
-        if not self.validator.validate(submission):
+        with span('SubmissionValidator.validate'):
+            valid = self.validator.validate(submission)
+        if not valid:
             raise HTTPException(400, 'invalid submission')
+        if self.guard is not None:
+            survey_id = combine(self.username, self.survey_name)
+            fingerprint = self.guard.fingerprint(submission, hint)
+            if await self.guard.contains(survey_id, fingerprint):
+                raise HTTPException(409, 'duplicate submission')
         submission = {
             'submission_time': submission_time,
             'data': submission,
         }
         if self.authentication == 'open':
             await self.submissions.insert_one(submission)
+            commit()
+            if self.guard is not None:
+                await self.guard.add(survey_id, fingerprint)
         if self.authentication == 'email':
             submission['_id'] = secrets.token_hex(32)
             while True:
                 try:
                     await self.submissions.insert_one(submission)
+                    commit()
                     break
                 except DuplicateKeyError:
                     submission['_id'] = secrets.token_hex(32)
@@ -246,8 +773,35 @@ class Survey:
             if status != 200:
                 raise HTTPException(500, 'email delivery failure')
         if self.authentication == 'invitation':
-            raise HTTPException(501, 'not implemented')
+            if token is None:
+                raise HTTPException(401, 'invalid token')
+            invitation = await self.invitations.find_one(
+                filter={'_id': digest(token), 'used': False},
+                projection={'_id': True},
+            )
+            if invitation is None:
+                raise HTTPException(401, 'invalid token')
+            # the submission is keyed by the invitation, such that a token
+            # is only used up once its submission is stored, and only once
+            submission['_id'] = invitation['_id']
+            try:
+                await self.submissions.insert_one(submission)
+            except DuplicateKeyError:
+                raise HTTPException(401, 'invalid token')
+            commit()
+            await self.invitations.update_one(
+                filter={'_id': invitation['_id']},
+                update={'$set': {'used': True}},
+            )
+        if self.authentication == 'email':
+            await self.histogram.add(submission_time)
+        else:
+            await asyncio.gather(
+                self.histogram.add(submission_time),
+                self.alligator.invalidate(),
+            )
 
+    @traced('Survey.verify')
     async def verify(self, verification_token):
         """Verify the user's email address and save submission as verified."""
         verification_time = now()
@@ -269,13 +823,46 @@ class Survey:
             replacement=submission,
             upsert=True,
         )
+        commit()
+        await self.alligator.invalidate()
         return RedirectResponse(
             f'{FRONTEND_URL}/{self.username}/{self.survey_name}/success'
         )
 
-    async def aggregate(self):
-        """Query the survey submissions and return aggregated results."""
+    async def crosstab(self, row, column):
+        """Return the joint answer counts of two categorical fields."""
+        for index in [row, column]:
+            if not 1 <= index <= len(self.configuration['fields']):
+                raise HTTPException(400, 'invalid field index')
+            field = self.configuration['fields'][index-1]
+            if field['type'] not in ['option', 'radio', 'selection']:
+                raise HTTPException(400, 'invalid field type')
+        return await self.alligator.crosstab(row, column)
+
+    async def aggregate(self, if_none_match=None):
+        """Query the survey submissions and return aggregated results.
+
+        The ETag is the submission version of the results, which allows us to
+        answer conditional requests with a 304 response after only reading
+        the version. Results are only available for closed surveys, where no
+        further submissions can arrive. They can still change when the owner
+        resets the survey, which is why clients may only reuse them briefly
+        before revalidating them.
+
+        """
         if now() < self.end:
             raise HTTPException(400, 'survey is not yet closed')
-        self.results = self.results or await self.alligator.fetch()
-        return self.results
+        version = await self.alligator.fetch_version()
+        headers = {
+            'ETag': f'"{version}"',
+            'Cache-Control': (
+                f'public, max-age={RESULTS_MAX_AGE}, must-revalidate'
+            ),
+        }
+        if matches(if_none_match, headers['ETag']):
+            return Response(status_code=304, headers=headers)
+        return Response(
+            content=await self.alligator.fetch_serialized(version),
+            media_type='application/json',
+            headers=headers,
+        )
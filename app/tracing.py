@@ -0,0 +1,128 @@
+import os
+import time
+import logging
+import random
+import inspect
+import functools
+import contextlib
+import contextvars
+import collections
+
+try:
+    from opentelemetry import trace
+except ImportError:  # fall back to the local tracer without opentelemetry
+    trace = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# number of recently finished spans kept by the local exporter
+TRACING_BUFFER = int(os.getenv('TRACING_BUFFER', 1000))
+
+
+class LocalExporter:
+    """Keeps the most recently finished spans in memory and logs them."""
+
+    def __init__(self, maxlen):
+        """Initialize an exporter keeping at most maxlen spans."""
+        self.spans = collections.deque(maxlen=maxlen)
+
+    def export(self, span):
+        """Keep and log the given finished span."""
+        self.spans.append(span)
+        logger.debug(
+            '%s %.1fms trace=%s span=%s parent=%s',
+            span['name'],
+            span['duration'] * 1000,
+            span['trace_id'],
+            span['span_id'],
+            span['parent_id'],
+        )
+
+
+# span that is currently active in the local tracer
+SPAN = contextvars.ContextVar('span', default=None)
+# exporter of the finished spans of the local tracer
+EXPORTER = LocalExporter(TRACING_BUFFER)
+
+
+@contextlib.contextmanager
+def _local_span(name, attributes):
+    """Record a span in the local tracer, nested in the active span.
+
+    The active span is kept in a context variable, which asyncio copies
+    into every task it creates. Spans of concurrent or background tasks
+    thus have the span that was active when the task was created as parent.
+
+    """
+    parent = SPAN.get()
+    span = {
+        'name': name,
+        'trace_id': (
+            parent['trace_id']
+            if parent
+            else f'{random.getrandbits(128):032x}'
+        ),
+        'span_id': f'{random.getrandbits(64):016x}',
+        'parent_id': parent['span_id'] if parent else None,
+        'attributes': dict(attributes),
+        'start': time.time(),
+        'duration': None,
+        'error': None,
+    }
+    token = SPAN.set(span)
+    start = time.perf_counter()
+    try:
+        yield span['attributes']
+    except BaseException as error:
+        span['error'] = repr(error)
+        raise
+    finally:
+        span['duration'] = time.perf_counter() - start
+        SPAN.reset(token)
+        EXPORTER.export(span)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Trace the enclosed block as span of the given name.
+
+    With opentelemetry installed, spans are recorded by its tracer and
+    exported as configured by its SDK. Otherwise, they are recorded by the
+    local tracer and kept by the local exporter. In both cases the block
+    can add further attributes to the yielded dictionary.
+
+    """
+    if trace is None:
+        with _local_span(name, attributes) as attributes:
+            yield attributes
+        return
+    tracer = trace.get_tracer(__name__)
+    with tracer.start_as_current_span(name, attributes=attributes) as s:
+        attributes = {}
+        yield attributes
+        s.set_attributes(attributes)
+
+
+def traced(name):
+    """Decorate a function or coroutine function to trace its calls."""
+
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+
+        else:
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with span(name):
+                    return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,5 +1,8 @@
 import re
 import time
+import hashlib
+
+import orjson
 
 
 def combine(username, survey_name):
@@ -7,6 +10,59 @@ def combine(username, survey_name):
     return f'{username}.{survey_name}'
 
 
+def digest(token):
+    """Return the hexadecimal sha256 hash of the given token string."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def fingerprint(fields):
+    """Return a hash identifying the structure of the given survey fields.
+
+    Titles, descriptions and hints only affect how the fields are displayed,
+    not how submissions are validated or aggregated, which is why they are
+    left out. Surveys cloned from the same template thus share a fingerprint
+    even if their texts were changed.
+
+    """
+
+    def _strip(field):
+        """Recursively remove the purely descriptive keys of a field."""
+        return {
+            key: (
+                [_strip(subfield) for subfield in value]
+                if key == 'fields'
+                else value
+            )
+            for key, value
+            in field.items()
+            if key not in ['title', 'description', 'hint']
+        }
+
+    dump = orjson.dumps(
+        [_strip(field) for field in fields],
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.sha256(dump).hexdigest()
+
+
+def matches(if_none_match, etag):
+    """Check if an If-None-Match header value matches the given ETag.
+
+    As required for If-None-Match, the comparison is weak, which means that
+    the W/ prefixes of weak ETags are ignored.
+
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return etag in [
+        tag[2:] if tag.startswith('W/') else tag
+        for tag
+        in [e.strip() for e in if_none_match.split(',')]
+    ]
+
+
 def isregex(value):
     """Check if a given value is a valid regular expression."""
     try:
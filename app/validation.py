@@ -1,8 +1,13 @@
 import re
 
 from cerberus import Validator, TypeDefinition
+from cachetools import LRUCache
 
-from app.utils import isregex
+from app.utils import isregex, fingerprint
+
+
+# compiled validation schemas of recently used field structures
+SCHEMAS = LRUCache(maxsize=1024)
 
 
 class SubmissionValidator(Validator):
@@ -30,11 +35,22 @@ class SubmissionValidator(Validator):
         multiple times, though, that's why using a factory method is the
         easier way.
 
+        Compiled schemas are shared between surveys with the same field
+        structure, which saves generating and compiling them again for
+        surveys cloned from the same template. Cerberus keeps a compiled
+        schema as it is instead of compiling it again. Every survey still
+        gets its own validator instance, as cerberus validators keep the
+        document and errors of their last validation. The schema is thus
+        compiled by a separate validator that never validates anything.
+
         """
-        return cls(
-            cls._generate_validation_schema(configuration),
-            require_all=True,
-        )
+        identifier = fingerprint(configuration['fields'])
+        if identifier not in SCHEMAS:
+            SCHEMAS[identifier] = cls(
+                cls._generate_validation_schema(configuration),
+                require_all=True,
+            ).schema
+        return cls(SCHEMAS[identifier], require_all=True)
 
     @staticmethod
     def _generate_validation_schema(configuration):
@@ -332,7 +348,8 @@ class ConfigurationValidator(Validator):
         }
         return (
             type(value) is dict
-            and set(value.keys()) == keys
+            and keys <= set(value.keys()) <= keys | {'deduplicate'}
+            and type(value.get('deduplicate', False)) == bool
             and type(value['survey_name']) == str
             and re.match(self.REGEXES['survey_name'], value['survey_name'])
             and type(value['title']) == str
@@ -342,7 +359,7 @@ class ConfigurationValidator(Validator):
             and type(value['start']) == type(value['end']) == int
             and value['start'] <= value['end']
             and type(value['draft']) == bool
-            and value['authentication'] in ['open', 'email']
+            and value['authentication'] in ['open', 'email', 'invitation']
             and type(value['limit']) == int
             and value['limit'] >= 0
             and type(value['fields']) == list
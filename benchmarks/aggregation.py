@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from app.aggregation import Alligator
+from app import storage
+
+
+# MongoDB connection string
+MONGODB_CONNECTION_STRING = os.getenv('MONGODB_CONNECTION_STRING')
+
+
+def generate_submission(configuration):
+    """Generate a random valid submission for the given configuration."""
+    submission = {}
+    for index, field in enumerate(configuration['fields']):
+        key = str(index + 1)
+        if field['type'] == 'email':
+            submission[key] = f'test+{random.getrandbits(32)}@fastsurvey.io'
+        if field['type'] == 'option':
+            submission[key] = random.random() < 0.5
+        if field['type'] == 'radio':
+            choice = random.randrange(len(field['fields']))
+            submission[key] = {
+                str(i + 1): i == choice
+                for i
+                in range(len(field['fields']))
+            }
+        if field['type'] == 'selection':
+            submission[key] = {
+                str(i + 1): random.random() < 0.5
+                for i
+                in range(len(field['fields']))
+            }
+        if field['type'] == 'text':
+            submission[key] = ' '.join(
+                random.choice(['ice', 'cream', 'is', 'cool', 'and', 'tasty'])
+                for _
+                in range(random.randint(2, 20))
+            )
+    return submission
+
+
+async def measure(alligator, repetitions):
+    """Return the best time in seconds of computing the survey results."""
+    timings = []
+    for _ in range(repetitions):
+        await alligator.resultss.delete_one({'_id': alligator.survey_id})
+        alligator.cache.pop(alligator.survey_id, None)
+        start = time.perf_counter()
+        await alligator.fetch()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+async def main(arguments):
+    """Compare single pipeline and partitioned aggregation performance."""
+    with open('tests/surveys/complex-survey/configuration.json', 'r') as e:
+        configuration = json.load(e)
+    configuration['username'] = 'benchmark'
+    configuration['authentication'] = 'open'
+    database = storage.create(
+        arguments.engine,
+        MONGODB_CONNECTION_STRING,
+        'benchmark',
+    )
+    alligators = {
+        partitions: Alligator(
+            configuration,
+            database,
+            partitions,
+            threshold=0,  # always aggregate via pipelines
+        )
+        for partitions
+        in sorted({1, *arguments.partitions})
+    }
+    collection = alligators[1].collection
+    await collection.drop()
+    for i in range(0, arguments.submissions, 10000):
+        await collection.insert_many([
+            {
+                'submission_time': i + j,
+                'data': generate_submission(configuration),
+            }
+            for j
+            in range(min(10000, arguments.submissions - i))
+        ])
+    results = None
+    for partitions, alligator in alligators.items():
+        seconds = await measure(alligator, arguments.repetitions)
+        output = await alligator.fetch()
+        assert results is None or output == results, 'results differ'
+        results = output
+        print(f'partitions: {partitions:>3}  time: {seconds:.3f}s')
+    await database.drop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--submissions', type=int, default=200000)
+    parser.add_argument('--partitions', type=int, nargs='+', default=[4, 8])
+    parser.add_argument('--repetitions', type=int, default=3)
+    parser.add_argument(
+        '--engine',
+        choices=['motor', 'memory'],
+        default='motor',
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -2,6 +2,7 @@ import pytest
 import asyncio
 import json
 import os
+import re
 
 from copy import deepcopy
 
@@ -179,3 +180,23 @@ async def cleanup(username, email_address, password, configurations):
     """Reset survey data and configurations after a single test."""
     yield
     await reset(username, email_address, password, configurations)
+
+
+@pytest.fixture(scope='session')
+def roundtrips():
+    """Provide a function returning the database round trips of a response.
+
+    The count is parsed from the `Server-Timing` header, such that tests can
+    assert that routes stay within their budget of database round trips.
+
+    """
+
+    def _roundtrips(response):
+        """Return the number of round trips reported in the response."""
+        match = re.search(
+            r'db;dur=[0-9.]+;desc="([0-9]+) round trips"',
+            response.headers['server-timing'],
+        )
+        return int(match.group(1))
+
+    return _roundtrips
@@ -0,0 +1,81 @@
+import pytest
+
+import app.main as main
+
+
+@pytest.mark.asyncio
+async def test_paginating_configurations(username, configurations):
+    """Test that paging through the configurations returns each one once."""
+    survey_names = []
+    after = None
+    while True:
+        page = await main.account_manager._fetch_configurations(
+            username=username,
+            after=after,
+            limit=4,
+            fields=['title'],
+        )
+        for configuration in page['configurations']:
+            assert set(configuration.keys()) == {'title'}
+            survey_names.append(configuration['title'])
+        after = page['after']
+        if after is None:
+            break
+    assert sorted(survey_names) == sorted(
+        configuration['title']
+        for configuration
+        in configurations.values()
+    )
+
+
+@pytest.mark.asyncio
+async def test_fetching_summaries(username, configurations):
+    """Test that the summaries contain metadata and submission counts."""
+    summaries = await main.account_manager._fetch_summaries(username)
+    assert len(summaries) == len(configurations)
+    for summary in summaries:
+        configuration = configurations[summary['survey_name']]
+        assert summary['title'] == configuration['title']
+        assert summary['status'] == 'open'
+        assert summary['submitted'] == summary['verified'] == 0
+
+
+@pytest.mark.asyncio
+async def test_deleting_account_with_surveys(username, configurations, cleanup):
+    """Test that deleting an account also deletes all of its surveys."""
+    for survey_name in configurations.keys():
+        await main.survey_manager._fetch(username, survey_name)
+    await main.account_manager._delete(username)
+    account = await main.database['accounts'].find_one({'_id': username})
+    assert account is None
+    count = await main.database['configurations'].count_documents(
+        filter={'username': username},
+    )
+    assert count == 0
+    assert not any(
+        survey_id.startswith(f'{username}.')
+        for survey_id
+        in main.survey_manager.cache.keys()
+    )
+
+
+@pytest.mark.asyncio
+async def test_updating_account_keeps_credentials(
+        username,
+        password,
+        cleanup,
+    ):
+    """Test that users can still log in after updating their account."""
+    await main.database['accounts'].update_one(
+        filter={'_id': username},
+        update={'$set': {'verified': True}},
+    )
+    email_address = 'update@fastsurvey.io'
+    await main.account_manager._update(
+        username,
+        {'username': username, 'email_address': email_address},
+    )
+    account = await main.account_manager._fetch(username)
+    assert account['email_address'] == email_address
+    assert account['verified'] is True
+    assert await main.account_manager.authenticate(email_address, password)
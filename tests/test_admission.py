@@ -0,0 +1,59 @@
+import pytest
+import asyncio
+
+from fastapi import HTTPException
+
+import app.admission as admission
+
+
+@pytest.mark.asyncio
+async def test_requests_beyond_queue_are_rejected():
+    """Test that requests are shed once concurrency and queue are full."""
+    controller = admission.AdmissionController(concurrency=1, queue=1)
+    event = asyncio.Event()
+
+    async def process():
+        async with controller.admit('survey'):
+            await event.wait()
+
+    tasks = [asyncio.create_task(process()) for _ in range(2)]
+    await asyncio.sleep(0)
+    assert controller.statistics['active'] == 1
+    assert controller.statistics['waiting'] == 1
+    with pytest.raises(HTTPException) as e:
+        async with controller.admit('survey'):
+            pass
+    assert e.value.status_code == 503
+    assert e.value.headers['Retry-After'] == '1'
+    async with controller.admit('other'):
+        pass
+    event.set()
+    await asyncio.gather(*tasks)
+    statistics = controller.statistics
+    assert statistics['admitted'] == 3
+    assert statistics['rejected'] == 1
+    assert statistics['active'] == statistics['waiting'] == 0
+    assert controller.semaphores == {}
+
+
+def test_routes_are_prioritized():
+    """Test that results are shed first and submissions last."""
+    shedder = admission.LoadShedder(lag=0.1, inflight=10)
+    routes = {
+        ('GET', '/users/x/surveys/y/results'): 'low',
+        ('GET', '/users/x/surveys/y/results/histogram'): 'low',
+        ('GET', '/users/x/surveys'): 'low',
+        ('GET', '/users/x/surveys/y'): 'normal',
+        ('POST', '/users/x/surveys/y/submissions'): 'high',
+        ('GET', '/users/x/surveys/y/verification/z'): 'high',
+    }
+    for (method, path), priority in routes.items():
+        assert shedder._prioritize(method, path) == priority
+    shedder.lag = 0.3
+    assert shedder.overloaded('low')
+    assert shedder.overloaded('normal')
+    assert not shedder.overloaded('high')
+    shedder.lag = 0
+    shedder.inflight = 10
+    assert shedder.overloaded('low')
+    assert not shedder.overloaded('normal')
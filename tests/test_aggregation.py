@@ -1,3 +1,5 @@
+import pytest
+
 import app.main as main
 import app.aggregation as aggregation
 import app.utils as utils
@@ -19,6 +21,7 @@ def test_adding_email_to_aggregation_pipeline(username, configurations):
         '_id': f'{username}.email',
         'count': {'$sum': 1},
     }
+    assert set(alligator.stream.keys()) == {'1'}
 
 
 def test_adding_option_to_aggregation_pipeline(username, configurations):
@@ -114,3 +117,170 @@ def test_adding_text_to_aggregation_pipeline(username, configurations):
         '_id': f'{username}.text',
         'count': {'$sum': 1},
     }
+    assert set(alligator.stream.keys()) == {'1'}
+
+
+@pytest.mark.asyncio
+async def test_rolling_up_submission_histogram(username, cleanup):
+    """Test that submission times are counted in the correct buckets."""
+    survey = await main.survey_manager._fetch(username, 'option')
+    for timestamp in [90061, 90119, 90120, 97200]:
+        await survey.histogram.add(timestamp)
+    assert await survey.histogram.fetch() == {
+        'minute': {'90060': 2, '90120': 1, '97200': 1},
+        'hour': {'90000': 3, '97200': 1},
+        'day': {'86400': 4},
+    }
+
+
+@pytest.mark.asyncio
+async def test_aggregating_partitioned(
+        username,
+        submissionss,
+        resultss,
+        cleanup,
+    ):
+    """Test that partitioned aggregation returns the same results."""
+    for survey_name, submissions in submissionss.items():
+        survey = await main.survey_manager._fetch(username, survey_name)
+        alligator = aggregation.Alligator(
+            configuration=survey.configuration,
+            database=main.database,
+            partitions=3,
+            threshold=0,
+        )
+        await alligator.collection.insert_many([
+            {'data': submission}
+            for submission
+            in submissions['valid']
+        ])
+        assert await alligator.fetch() == resultss[survey_name]
+
+
+@pytest.mark.asyncio
+async def test_aggregating_vectorized_and_pipelined_identically(
+        username,
+        submissionss,
+        resultss,
+        cleanup,
+    ):
+    """Test that the local engine returns the same results as the pipeline."""
+    for survey_name, submissions in submissionss.items():
+        survey = await main.survey_manager._fetch(username, survey_name)
+        await survey.alligator.collection.insert_many([
+            {'data': submission}
+            for submission
+            in submissions['valid']
+        ])
+        for threshold in [0, 1000]:
+            alligator = aggregation.Alligator(
+                configuration=survey.configuration,
+                database=main.database,
+                threshold=threshold,
+            )
+            await alligator.resultss.delete_one({'_id': alligator.survey_id})
+            assert await alligator.fetch() == resultss[survey_name]
+
+
+@pytest.mark.asyncio
+async def test_crosstabulating_fields(username, submissionss, cleanup):
+    """Test the joint counts of two fields and their invalidation."""
+    survey_name = 'complex-survey'
+    survey = await main.survey_manager._fetch(username, survey_name)
+    submissions = submissionss[survey_name]['valid']
+    await survey.alligator.collection.insert_many([
+        {'data': submission}
+        for submission
+        in submissions[:4]
+    ])
+    assert await survey.crosstab(2, 3) == {
+        '1': {'1': 1, '2': 0, '3': 2, '4': 1},
+    }
+    await survey.alligator.collection.insert_one({'data': submissions[4]})
+    await survey.alligator.invalidate()
+    assert await survey.crosstab(2, 3) == {
+        '1': {'1': 1, '2': 0, '3': 3, '4': 1},
+    }
+    assert await survey.crosstab(3, 4) == {
+        '1': {'1': 0, '2': 0, '3': 0},
+        '2': {'1': 0, '2': 0, '3': 0},
+        '3': {'1': 3, '2': 1, '3': 1},
+        '4': {'1': 1, '2': 0, '3': 1},
+    }
+
+
+@pytest.mark.asyncio
+async def test_crosstabulating_after_reset(username, submissionss, cleanup):
+    """Test that crosstabs are recomputed despite unchanged counts."""
+    survey_name = 'complex-survey'
+    survey = await main.survey_manager._fetch(username, survey_name)
+    submissions = submissionss[survey_name]['valid']
+    await survey.alligator.collection.insert_many([
+        {'data': submission}
+        for submission
+        in submissions[:2]
+    ])
+    before = await survey.crosstab(3, 4)
+    await main.survey_manager._reset(username, survey_name)
+    await survey.alligator.collection.insert_many([
+        {'data': submission}
+        for submission
+        in submissions[2:4]
+    ])
+    after = await survey.crosstab(3, 4)
+    alligator = aggregation.Alligator(survey.configuration, main.database)
+    assert after == await alligator.crosstab(3, 4)
+    assert after != before
+
+
+@pytest.mark.asyncio
+async def test_caching_versioned_results(username, submissionss, cleanup):
+    """Test that results are served cached until the version changes."""
+    survey_name = 'option'
+    survey = await main.survey_manager._fetch(username, survey_name)
+    alligator = survey.alligator
+    submission = submissionss[survey_name]['valid'][0]
+    await alligator.collection.insert_one({'data': submission})
+    await alligator.invalidate()
+    assert (await alligator.fetch())['count'] == 1
+    # results are served from the cache without touching the database
+    await alligator.resultss.delete_one({'_id': alligator.survey_id})
+    assert (await alligator.fetch())['count'] == 1
+    # new submissions invalidate both local and stored results
+    await alligator.collection.insert_one({'data': submission})
+    await alligator.invalidate()
+    assert (await alligator.fetch())['count'] == 2
+    results = await alligator.resultss.find_one({'_id': alligator.survey_id})
+    assert results['version'] == await alligator.fetch_version()
+
+
+@pytest.mark.asyncio
+async def test_aggregating_during_reset(
+        monkeypatch,
+        username,
+        submissionss,
+        cleanup,
+    ):
+    """Test that results deleted while aggregating are recomputed."""
+    survey_name = 'option'
+    survey = await main.survey_manager._fetch(username, survey_name)
+    alligator = aggregation.Alligator(
+        configuration=survey.configuration,
+        database=main.database,
+    )
+    submission = submissionss[survey_name]['valid'][0]
+    await alligator.collection.insert_one({'data': submission})
+    await alligator.invalidate()
+    find_one_and_update = alligator.resultss.find_one_and_update
+
+    async def reset(*args, **kwargs):
+        """Reset the survey right before the results are stamped."""
+        monkeypatch.undo()
+        await main.survey_manager._reset(username, survey_name)
+        return await find_one_and_update(*args, **kwargs)
+
+    monkeypatch.setattr(alligator.resultss, 'find_one_and_update', reset)
+    assert await alligator.fetch() == {}
+    await alligator.collection.insert_one({'data': submission})
+    await alligator.invalidate()
+    assert (await alligator.fetch())['count'] == 1
@@ -0,0 +1,82 @@
+import pytest
+
+import app.main as main
+import app.caching as caching
+import app.survey as survey
+import app.utils as utils
+
+
+class Entry:
+    """Cacheable object reporting a fixed size in bytes."""
+
+    def __init__(self, size):
+        self.size = size
+
+
+def test_sizeof_counts_nested_values():
+    """Test that the size of a value includes the size of its members."""
+    assert caching.sizeof({'a': [1, 2]}) > caching.sizeof({'a': []})
+    assert caching.sizeof(['abc']) > caching.sizeof([])
+
+
+def test_cache_evicts_by_size():
+    """Test that the cache evicts least recently used entries by size."""
+    cache = caching.SurveyCache(maxsize=100)
+    cache['a'] = Entry(40)
+    cache['b'] = Entry(40)
+    assert cache.get('a') is not None
+    cache['c'] = Entry(40)
+    assert set(cache.keys()) == {'a', 'c'}
+    assert cache.statistics['bytes'] == 80
+    assert cache.statistics['evictions'] == 1
+
+
+def test_cache_rejects_oversized_entries():
+    """Test that entries larger than the whole cache are rejected."""
+    cache = caching.SurveyCache(maxsize=100)
+    with pytest.raises(ValueError):
+        cache['a'] = Entry(101)
+    assert len(cache) == 0
+
+
+def test_cache_resizes_grown_entries():
+    """Test that grown entries are accounted for and evict others."""
+    cache = caching.SurveyCache(maxsize=100)
+    entry = Entry(40)
+    cache['a'] = entry
+    cache['b'] = Entry(40)
+    entry.size = 70
+    cache.resize('a', entry)
+    assert set(cache.keys()) == {'a'}
+    assert cache.statistics['bytes'] == 70
+    entry.size = 101
+    cache.resize('a', entry)
+    assert len(cache) == 0
+
+
+def test_surveys_resize_when_building_lazy_members(username, configurations):
+    """Test that the cached size of surveys includes their lazy members."""
+    cache = caching.SurveyCache(maxsize=2**20)
+    configuration = {'username': username, **configurations['radio']}
+    cached = survey.Survey(configuration, main.database, None, cache=cache)
+    cache[utils.combine(username, cached.survey_name)] = cached
+    size = cache.currsize
+    assert cached.validator is not None
+    assert cache.currsize > size
+    size = cache.currsize
+    assert cached.alligator is not None
+    assert cache.currsize > size
+    assert cache.currsize == cached.size
+
+
+def test_cache_statistics():
+    """Test that the cache counts its hits and misses."""
+    cache = caching.SurveyCache(maxsize=100)
+    cache['a'] = Entry(10)
+    cache.get('a')
+    cache.get('a')
+    cache.get('b')
+    statistics = cache.statistics
+    assert statistics['entries'] == 1
+    assert statistics['hits'] == 2
+    assert statistics['misses'] == 1
@@ -0,0 +1,55 @@
+import pytest
+
+import app.main as main
+import app.deduplication as deduplication
+
+
+@pytest.mark.asyncio
+async def test_detecting_duplicate_submissions(username, cleanup):
+    """Test that repeated submissions are detected across restarts."""
+    survey_id = f'{username}.option'
+    guard = deduplication.DuplicateGuard(main.database)
+    fingerprint = guard.fingerprint
+    assert not await guard.contains(survey_id, fingerprint({'1': ' Yes'}, 1))
+    await guard.add(survey_id, fingerprint({'1': ' Yes'}, 1))
+    assert await guard.contains(survey_id, fingerprint({'1': 'yes '}, 1))
+    assert not await guard.contains(survey_id, fingerprint({'1': 'yes'}, 2))
+    await guard.persist()
+    guard = deduplication.DuplicateGuard(main.database)
+    assert await guard.contains(survey_id, fingerprint({'1': 'yes'}, 1))
+    await guard.discard(survey_id)
+    assert not await guard.contains(survey_id, fingerprint({'1': 'yes'}, 1))
+
+
+@pytest.mark.asyncio
+async def test_merging_filters_of_multiple_workers(
+        monkeypatch,
+        username,
+        cleanup,
+):
+    """Test that workers merge their fingerprints and retry failed writes."""
+    monkeypatch.setattr(deduplication.DuplicateGuard, 'SLICE', 256)
+    survey_id = f'{username}.option'
+    a = deduplication.DuplicateGuard(main.database)
+    b = deduplication.DuplicateGuard(main.database)
+    await a.load(survey_id)
+    await b.load(survey_id)
+    for i in range(2000):
+        await (a if i % 2 else b).add(survey_id, str(i))
+    await a.persist()
+
+    async def fail(*args, **kwargs):
+        raise RuntimeError('write failed')
+
+    monkeypatch.setattr(b, '_persist', fail)
+    with pytest.raises(RuntimeError):
+        await b.persist()
+    assert b.modified == {survey_id}
+    monkeypatch.undo()
+    monkeypatch.setattr(deduplication.DuplicateGuard, 'SLICE', 256)
+    await b.persist()
+    assert not b.modified
+    assert all([await b.contains(survey_id, str(i)) for i in range(2000)])
+    c = deduplication.DuplicateGuard(main.database)
+    assert all([await c.contains(survey_id, str(i)) for i in range(2000)])
+    await c.discard(survey_id)
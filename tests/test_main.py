@@ -2,8 +2,11 @@ import pytest
 import secrets
 
 from httpx import AsyncClient
+from pymongo.errors import BulkWriteError, ConnectionFailure
 
 import app.main as main
+import app.idempotency as idempotency
+from app.utils import combine, digest, now
 
 
 @pytest.mark.asyncio
@@ -20,6 +23,23 @@ async def test_fetching_configuration_with_valid_identifier(
         assert response.json() == configuration
 
 
+@pytest.mark.asyncio
+async def test_fetching_configuration_conditionally(username, configurations):
+    """Test that unchanged configurations are answered with 304 responses."""
+    for survey_name, configuration in configurations.items():
+        async with AsyncClient(app=main.app, base_url='http://test') as ac:
+            url = f'/users/{username}/surveys/{survey_name}'
+            response = await ac.get(url)
+            etag = response.headers['etag']
+            response = await ac.get(url, headers={'If-None-Match': etag})
+            assert response.status_code == 304
+            assert response.headers['etag'] == etag
+            assert response.content == b''
+            response = await ac.get(url, headers={'If-None-Match': '"x"'})
+            assert response.status_code == 200
+            assert response.json() == configuration
+
+
 @pytest.mark.asyncio
 async def test_fetching_configuration_with_invalid_identifier(username):
     """Using invalid survey identifier, test that an exception is raised."""
@@ -127,6 +147,111 @@ async def test_verifying_valid_token(
             assert ve is not None  # now also in verified submissions
 
 
+@pytest.mark.asyncio
+async def test_submitting_with_invitation_token(
+        username,
+        configurations,
+        submissionss,
+        cleanup,
+    ):
+    """Test that invitation tokens are issued and can only be used once."""
+    survey_name = 'invitation'
+    configuration = {
+        **configurations['option'],
+        'survey_name': survey_name,
+        'authentication': 'invitation',
+    }
+    await main.survey_manager._create(username, survey_name, configuration)
+    survey = await main.survey_manager._fetch(username, survey_name)
+    email_addresses = [f'test+{i}@fastsurvey.io' for i in range(3)]
+    tokens = await survey.invite(email_addresses)
+    assert set(tokens.keys()) == set(email_addresses)
+    assert await survey.invite(email_addresses[:2]) == {}
+    submission = submissionss['option']['valid'][0]
+    async with AsyncClient(app=main.app, base_url='http://test') as ac:
+        url = f'/users/{username}/surveys/{survey_name}/submissions'
+        response = await ac.post(url, json=submission)
+        assert response.status_code == 401
+        for token in tokens.values():
+            for status_code in [200, 401]:
+                response = await ac.post(
+                    url=url,
+                    params={'token': token},
+                    json=submission,
+                )
+                assert response.status_code == status_code
+    assert await survey.submissions.count_documents({}) == len(tokens)
+
+
+@pytest.mark.asyncio
+async def test_submitting_with_invitation_token_after_failed_insert(
+        monkeypatch,
+        username,
+        configurations,
+        submissionss,
+        cleanup,
+    ):
+    """Test that invitation tokens stay valid if the submission fails."""
+    survey_name = 'invitation'
+    configuration = {
+        **configurations['option'],
+        'survey_name': survey_name,
+        'authentication': 'invitation',
+    }
+    await main.survey_manager._create(username, survey_name, configuration)
+    survey = await main.survey_manager._fetch(username, survey_name)
+    tokens = await survey.invite(['test@fastsurvey.io'])
+    submission = submissionss['option']['valid'][0]
+
+    async def fail(document):
+        """Fail to insert the submission."""
+        raise ConnectionFailure('connection lost')
+
+    monkeypatch.setattr(survey.submissions, 'insert_one', fail)
+    with pytest.raises(ConnectionFailure):
+        await survey.submit(submission, tokens['test@fastsurvey.io'])
+    monkeypatch.undo()
+    await survey.submit(submission, tokens['test@fastsurvey.io'])
+    assert await survey.submissions.count_documents({}) == 1
+    invitation = await survey.invitations.find_one()
+    assert invitation['used'] is True
+
+
+@pytest.mark.asyncio
+async def test_inviting_with_partially_failing_insert(
+        monkeypatch,
+        username,
+        configurations,
+        cleanup,
+    ):
+    """Test that the tokens of written invitations survive failed ones."""
+    survey_name = 'invitation'
+    configuration = {
+        **configurations['option'],
+        'survey_name': survey_name,
+        'authentication': 'invitation',
+    }
+    await main.survey_manager._create(username, survey_name, configuration)
+    survey = await main.survey_manager._fetch(username, survey_name)
+    insert_many = survey.invitations.insert_many
+
+    async def fail_first(documents, ordered=True):
+        """Insert the invitations but fail on the first one."""
+        await insert_many(documents[1:], ordered=ordered)
+        raise BulkWriteError({
+            'writeErrors': [{'index': 0, 'code': 2, 'errmsg': 'error'}],
+            'nInserted': len(documents) - 1,
+        })
+
+    monkeypatch.setattr(survey.invitations, 'insert_many', fail_first)
+    email_addresses = [f'test+{i}@fastsurvey.io' for i in range(3)]
+    tokens = await survey.invite(email_addresses)
+    assert set(tokens.keys()) == set(email_addresses[1:])
+    monkeypatch.undo()
+    tokens = await survey.invite(email_addresses)
+    assert set(tokens.keys()) == set(email_addresses[:1])
+
+
 @pytest.fixture(scope='function')
 async def scenario2(survey):
     """Load some predefined entries into the database for testing."""
@@ -239,3 +364,188 @@ async def test_aggregating(username, submissionss, resultss, cleanup):
             )
         assert response.status_code == 200
         assert response.json() == resultss[survey_name]
+        assert 'must-revalidate' in response.headers['cache-control']
+        async with AsyncClient(app=main.app, base_url='http://test') as ac:
+            response = await ac.get(
+                url=f'/users/{username}/surveys/{survey_name}/results',
+                headers={'If-None-Match': response.headers['etag']},
+            )
+        assert response.status_code == 304
+        # results of reset surveys are revalidated to the new version
+        await main.survey_manager._reset(username, survey_name)
+        async with AsyncClient(app=main.app, base_url='http://test') as ac:
+            response = await ac.get(
+                url=f'/users/{username}/surveys/{survey_name}/results',
+                headers={'If-None-Match': response.headers['etag']},
+            )
+        assert response.status_code == 200
+        assert response.json() == {}
+
+
+@pytest.mark.asyncio
+async def test_warming_survey_cache(username, configurations):
+    """Test that open surveys are preloaded into an empty survey cache."""
+    main.survey_manager.cache.clear()
+    await main.survey_manager.warm()
+    for survey_name in configurations.keys():
+        survey_id = f'{username}.{survey_name}'
+        assert survey_id in main.survey_manager.cache
+
+
+@pytest.mark.asyncio
+async def test_stopping_survey_cache_warmup(monkeypatch):
+    """Test that the background warm-up is cancelled on shutdown."""
+    monkeypatch.setattr('app.survey.SURVEY_CACHE_WARMUP', True)
+    main.survey_manager.start()
+    assert main.survey_manager.warmup is not None
+    await main.survey_manager.stop()
+    assert main.survey_manager.warmup is None
+
+
+@pytest.mark.asyncio
+async def test_submitting_oversized_submission(username, cleanup):
+    """Test that submissions larger than any valid one are rejected."""
+    survey_name = 'complex-survey'
+    survey = await main.survey_manager._fetch(username, survey_name)
+    async with AsyncClient(app=main.app, base_url='http://test') as ac:
+        url = f'/users/{username}/surveys/{survey_name}/submissions'
+        content = b'{"1": "' + b'x' * survey.max_body_size + b'"}'
+        response = await ac.post(url, data=content)
+        assert response.status_code == 413
+        response = await ac.post(
+            url=url,
+            data=b'{}',
+            headers={'content-length': 'many'},
+        )
+        assert response.status_code == 400
+    assert await survey.submissions.find_one() is None
+
+
+@pytest.mark.asyncio
+async def test_submitting_with_idempotency_key(
+        username,
+        submissionss,
+        cleanup,
+    ):
+    """Test that retried submissions with the same key are stored once."""
+    survey_name = 'option'
+    survey = await main.survey_manager._fetch(username, survey_name)
+    submission = submissionss[survey_name]['valid'][0]
+    headers = {'Idempotency-Key': secrets.token_hex(16)}
+    async with AsyncClient(app=main.app, base_url='http://test') as ac:
+        url = f'/users/{username}/surveys/{survey_name}/submissions'
+        for _ in range(3):
+            response = await ac.post(url, json=submission, headers=headers)
+            assert response.status_code == 200
+    assert await survey.submissions.count_documents({}) == 1
+
+
+@pytest.mark.asyncio
+async def test_submitting_with_abandoned_idempotency_key(
+        username,
+        submissionss,
+        cleanup,
+    ):
+    """Test that claims of requests that died are taken over eventually."""
+    survey_name = 'option'
+    survey = await main.survey_manager._fetch(username, survey_name)
+    submission = submissionss[survey_name]['valid'][0]
+    key = secrets.token_hex(16)
+    survey_id = combine(username, survey_name)
+    identifier = f'{survey_id}.submission.{digest(key)}'
+    timestamp = now()
+    await main.database['idempotency'].insert_one({
+        '_id': identifier,
+        'creation_time': timestamp,
+        'claim_time': timestamp,
+        'response': None,
+    })
+    headers = {'Idempotency-Key': key}
+    async with AsyncClient(app=main.app, base_url='http://test') as ac:
+        url = f'/users/{username}/surveys/{survey_name}/submissions'
+        response = await ac.post(url, json=submission, headers=headers)
+        assert response.status_code == 409
+        await main.database['idempotency'].update_one(
+            filter={'_id': identifier},
+            update={'$inc': {'claim_time': -idempotency.IDEMPOTENCY_LEASE}},
+        )
+        response = await ac.post(url, json=submission, headers=headers)
+        assert response.status_code == 200
+    assert await survey.submissions.count_documents({}) == 1
+
+
+@pytest.mark.asyncio
+async def test_submitting_with_idempotency_key_after_failure(
+        monkeypatch,
+        username,
+        submissionss,
+        cleanup,
+    ):
+    """Test that failures after the insert are replayed, not processed."""
+    survey_name = 'email'
+    survey = await main.survey_manager._fetch(username, survey_name)
+    submission = submissionss[survey_name]['valid'][0]
+
+    async def fail(*args, **kwargs):
+        """Fail to deliver the verification email."""
+        return 500
+
+    monkeypatch.setattr(
+        survey.letterbox,
+        'send_submission_verification_email',
+        fail,
+    )
+    headers = {'Idempotency-Key': secrets.token_hex(16)}
+    async with AsyncClient(app=main.app, base_url='http://test') as ac:
+        url = f'/users/{username}/surveys/{survey_name}/submissions'
+        for _ in range(3):
+            response = await ac.post(url, json=submission, headers=headers)
+            assert response.status_code == 500
+            assert response.json() == {'detail': 'email delivery failure'}
+    assert await survey.submissions.count_documents({}) == 1
+
+
+@pytest.mark.asyncio
+async def test_database_round_trip_budgets(
+        username,
+        submissionss,
+        roundtrips,
+        cleanup,
+    ):
+    """Test that routes stay within their budget of database round trips."""
+    survey_name = 'option'
+    survey = await main.survey_manager._fetch(username, survey_name)
+    submission = submissionss[survey_name]['valid'][0]
+    async with AsyncClient(app=main.app, base_url='http://test') as ac:
+        url = f'/users/{username}/surveys/{survey_name}'
+        response = await ac.get(url)
+        assert roundtrips(response) == 0
+        response = await ac.post(f'{url}/submissions', json=submission)
+        assert roundtrips(response) <= 3
+        survey.end = 0
+        response = await ac.get(f'{url}/results')
+        assert roundtrips(response) <= 6
+        response = await ac.get(f'{url}/results')
+        assert roundtrips(response) <= 1
+
+
+@pytest.mark.asyncio
+async def test_fetching_metrics(monkeypatch):
+    """Test that the metrics are only available if they are enabled."""
+    async with AsyncClient(app=main.app, base_url='http://test') as ac:
+        response = await ac.get('/metrics')
+        assert response.status_code == 404
+        monkeypatch.setattr(main, 'METRICS', True)
+        response = await ac.get('/metrics')
+        assert response.status_code == 200
+        assert set(response.json().keys()) == {'cache', 'admission', 'load'}
+
+
+@pytest.mark.asyncio
+async def test_documenting_submission_body():
+    """Test that the raw submission body is part of the OpenAPI schema."""
+    async with AsyncClient(app=main.app, base_url='http://test') as ac:
+        response = await ac.get('/openapi.json')
+    route = '/users/{username}/surveys/{survey_name}/submissions'
+    operation = response.json()['paths'][route]['post']
+    assert 'application/json' in operation['requestBody']['content']
@@ -0,0 +1,57 @@
+import pytest
+
+import app.main as main
+import app.scheduling as scheduling
+
+
+@pytest.mark.asyncio
+async def test_materializing_closed_surveys(
+        monkeypatch,
+        username,
+        submissionss,
+        resultss,
+        cleanup,
+    ):
+    """Test that the results of closed surveys are computed and stored."""
+    survey_name = 'option'
+    survey = await main.survey_manager._fetch(username, survey_name)
+    await survey.alligator.collection.insert_many([
+        {'data': submission}
+        for submission
+        in submissionss[survey_name]['valid']
+    ])
+    monkeypatch.setattr(scheduling, 'now', lambda: survey.end)
+    main.scheduler.checkpoint = survey.end - 1
+    await main.scheduler.materialize()
+    results = await main.database['resultss'].find_one(
+        filter={'_id': survey.alligator.survey_id},
+        projection={'_id': False, 'sketches': False, 'version': False},
+    )
+    assert results is not None
+    assert survey.alligator._restructure(results) == resultss[survey_name]
+    assert main.scheduler.checkpoint == survey.end
+
+
+@pytest.mark.asyncio
+async def test_retrying_failed_materializations(
+        monkeypatch,
+        username,
+        cleanup,
+    ):
+    """Test that failed surveys are released to be retried later."""
+    survey_name = 'option'
+    survey = await main.survey_manager._fetch(username, survey_name)
+
+    async def fail(version=None):
+        """Simulate a transient database error."""
+        raise RuntimeError('transient error')
+
+    monkeypatch.setattr(survey.alligator, 'fetch', fail)
+    monkeypatch.setattr(scheduling, 'now', lambda: survey.end)
+    main.scheduler.checkpoint = survey.end - 1
+    await main.scheduler.materialize()
+    claim = await main.database['materializations'].find_one(
+        filter={'_id': survey.alligator.survey_id},
+    )
+    assert claim is None
+    assert main.scheduler.checkpoint == survey.end - 1
@@ -0,0 +1,97 @@
+import app.sketches as sketches
+
+
+def test_space_saving_counting_exactly_within_capacity():
+    """Test that counts are exact as long as all items fit into the sketch."""
+    sketch = sketches.SpaceSaving(capacity=3)
+    for item in ['a', 'b', 'a', 'c', 'a', 'b']:
+        sketch.add(item)
+    assert sketch.top(3) == [('a', 3), ('b', 2), ('c', 1)]
+    assert sketch.top(1) == [('a', 3)]
+
+
+def test_space_saving_keeping_frequent_items():
+    """Test that frequent items survive a long tail of infrequent ones."""
+    sketch = sketches.SpaceSaving(capacity=10)
+    for i in range(1000):
+        sketch.add('frequent')
+        sketch.add(f'infrequent-{i}')
+    assert len(sketch.counts) == 10
+    assert len(sketch.heap) <= 4 * sketch.capacity
+    item, count = sketch.top(1)[0]
+    assert item == 'frequent'
+    assert count - sketch.errors[item] <= 1000 <= count
+
+
+def test_hyperloglog_estimating_distinct_counts():
+    """Test that the estimate is close to the number of distinct items."""
+    for n in [0, 1, 10, 1000, 100000]:
+        sketch = sketches.HyperLogLog()
+        for i in range(n):
+            sketch.add(f'test+{i}@fastsurvey.io')
+            sketch.add(f'test+{i}@fastsurvey.io')
+        assert abs(sketch.estimate() - n) <= 0.03 * n
+
+
+def test_hyperloglog_merging_partial_sketches():
+    """Test that merged sketches equal a sketch over the combined items."""
+    a, b, c = [sketches.HyperLogLog(precision=10) for _ in range(3)]
+    for i in range(5000):
+        (a if i % 2 else b).add(str(i))
+        c.add(str(i))
+    a.merge(sketches.HyperLogLog(10, b.serialize()))
+    assert a.registers == c.registers
+    assert a.estimate() == c.estimate()
+
+
+def test_space_saving_merging_partial_sketches():
+    """Test that merging sketches keeps frequent items and bounds errors."""
+    a = sketches.SpaceSaving(capacity=5)
+    b = sketches.SpaceSaving(capacity=5)
+    for i in range(100):
+        a.add('frequent')
+        b.add('frequent')
+        a.add(f'a-{i}')
+        b.add(f'b-{i}')
+    a.merge(b)
+    assert len(a.counts) == 5
+    item, count = a.top(1)[0]
+    assert item == 'frequent'
+    assert count - a.errors[item] <= 200 <= count
+
+
+def test_scalable_bloom_filter_error_rate():
+    """Test that added items are found and others only rarely."""
+    bloom = sketches.ScalableBloomFilter(capacity=100, error=0.01)
+    for i in range(10000):
+        bloom.add(str(i))
+    assert len(bloom.filters) > 1
+    assert all(str(i) in bloom for i in range(10000))
+    false = sum(str(i) in bloom for i in range(10000, 110000))
+    assert false / 100000 < 0.02
+
+
+def test_scalable_bloom_filter_serialization():
+    """Test that a deserialized filter contains the same items."""
+    bloom = sketches.ScalableBloomFilter(capacity=100, error=0.01)
+    for i in range(1000):
+        bloom.add(str(i))
+    copy = sketches.ScalableBloomFilter(
+        capacity=100,
+        error=0.01,
+        filters=bloom.serialize(),
+    )
+    assert all(str(i) in copy for i in range(1000))
+    assert not copy.add('0')
+
+
+def test_bloom_filter_merging_slices():
+    """Test that merging slices of filters results in their union."""
+    a = sketches.BloomFilter(capacity=1000, error=0.01)
+    b = sketches.BloomFilter(capacity=1000, error=0.01)
+    for i in range(500):
+        (a if i % 2 else b).add(str(i))
+    for offset in range(0, len(b.bits), 100):
+        a.merge(b.bits[offset:offset + 100], offset)
+    assert all(str(i) in a for i in range(500))
+    assert abs(a.estimate() - 500) <= 0.05 * 500
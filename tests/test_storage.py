@@ -0,0 +1,134 @@
+import pytest
+
+from pymongo import ReturnDocument, DESCENDING
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+
+import app.storage as storage
+
+
+@pytest.fixture(scope='function')
+def collection():
+    """Provide an empty collection of a fresh memory storage."""
+    return storage.create('memory')['test']
+
+
+@pytest.mark.asyncio
+async def test_querying_with_operators_sort_and_projection(collection):
+    """Test that queries filter, sort, limit and project like MongoDB."""
+    await collection.insert_many([
+        {'_id': i, 'start': i % 3, 'data': {'1': i, '2': -i}}
+        for i
+        in range(10)
+    ])
+    cursor = collection.find(
+        filter={'$or': [{'start': {'$lt': 2}}, {'data.1': 8}]},
+        projection={'_id': False, 'data.1': True},
+        sort=[('start', DESCENDING), ('data.1', DESCENDING)],
+        limit=4,
+    )
+    documents = await cursor.to_list(None)
+    assert documents == [
+        {'data': {'1': 8}},
+        {'data': {'1': 7}},
+        {'data': {'1': 4}},
+        {'data': {'1': 1}},
+    ]
+    assert await collection.count_documents({'start': 0}) == 4
+    document = await collection.find_one(
+        filter={'_id': 5},
+        projection={'data': False},
+    )
+    assert document == {'_id': 5, 'start': 2}
+
+
+@pytest.mark.asyncio
+async def test_enforcing_unique_indexes(collection):
+    """Test that unique indexes reject duplicates like MongoDB."""
+    await collection.create_index(keys='email', unique=True)
+    await collection.insert_one({'_id': 1, 'email': 'a'})
+    with pytest.raises(DuplicateKeyError):
+        await collection.insert_one({'_id': 2, 'email': 'a'})
+    with pytest.raises(DuplicateKeyError):
+        await collection.insert_one({'_id': 1, 'email': 'b'})
+    with pytest.raises(BulkWriteError) as error:
+        await collection.insert_many(
+            [{'email': 'a'}, {'email': 'b'}, {'email': 'a'}],
+            ordered=False,
+        )
+    errors = error.value.details['writeErrors']
+    assert [e['index'] for e in errors] == [0, 2]
+    assert all(e['code'] == 11000 for e in errors)
+    await collection.delete_one({'email': 'a'})
+    await collection.insert_one({'email': 'a'})
+    assert await collection.estimated_document_count() == 2
+
+
+@pytest.mark.asyncio
+async def test_updating_and_upserting(collection):
+    """Test that update operators and upserts behave like MongoDB."""
+    result = await collection.update_one(
+        filter={'_id': 'x'},
+        update={'$inc': {'count': 1, 'hours.1': 2}, '$setOnInsert': {'a': 1}},
+        upsert=True,
+    )
+    assert result.matched_count == 0
+    result = await collection.update_one(
+        filter={'_id': 'x'},
+        update={'$inc': {'count': 1}, '$setOnInsert': {'a': 2}},
+    )
+    assert result.matched_count == 1
+    document = await collection.find_one_and_update(
+        filter={'_id': 'x'},
+        update={'$set': {'version': 3}},
+        projection={'_id': False},
+        return_document=ReturnDocument.AFTER,
+    )
+    assert document == {'count': 2, 'hours': {'1': 2}, 'a': 1, 'version': 3}
+    result = await collection.replace_one({'_id': 'y'}, {'value': 1})
+    assert result.matched_count == 0
+    assert await collection.find_one({'_id': 'y'}) is None
+    await collection.drop()
+    assert await collection.find_one({'_id': 'x'}) is None
+
+
+@pytest.mark.asyncio
+async def test_aggregating_into_results():
+    """Test that pipelines group, sum and merge their output like MongoDB."""
+    database = storage.create('memory')
+    collection = database['test']
+    await collection.insert_many([
+        {'_id': i, 'data': {'1': i % 2 == 0, '2': {'1': i < 3}}}
+        for i
+        in range(5)
+    ])
+    assert await collection.find_one({'_id': 3, 'data.1': True}) is None
+    cursor = collection.aggregate([
+        {'$match': {'_id': {'$gte': 1}}},
+        {'$project': {'data.1': {'$toInt': '$data.1'}}},
+        {'$group': {
+            '_id': 'x',
+            'count': {'$sum': 1},
+            '1': {'$sum': '$data.1'},
+        }},
+        {'$merge': {
+            'into': 'results',
+            'on': '_id',
+            'whenMatched': 'replace',
+            'whenNotMatched': 'insert',
+        }},
+    ])
+    assert await cursor.to_list(None) == []
+    results = await database['results'].find_one({'_id': 'x'})
+    assert results == {'_id': 'x', 'count': 4, '1': 2}
+    cursor = collection.aggregate([{'$group': {
+        '_id': None,
+        '1+1': {
+            '$sum': {'$cond': [{'$and': ['$data.1', '$data.2.1']}, 1, 0]},
+        },
+    }}])
+    assert await cursor.to_list(None) == [{'_id': None, '1+1': 2}]
+    cursor = collection.aggregate([
+        {'$match': {'_id': {'$gte': 5}}},
+        {'$group': {'_id': None, 'count': {'$sum': 1}}},
+    ])
+    assert await cursor.to_list(None) == []
@@ -0,0 +1,36 @@
+import pytest
+import asyncio
+
+import app.tracing as tracing
+
+
+pytestmark = pytest.mark.skipif(
+    tracing.trace is not None,
+    reason='spans are exported by opentelemetry',
+)
+
+
+@pytest.mark.asyncio
+async def test_propagating_spans_across_tasks():
+    """Test that spans of tasks are nested in the span creating the task."""
+    tracing.EXPORTER.spans.clear()
+
+    @tracing.traced('child')
+    async def child():
+        await asyncio.sleep(0)
+
+    with tracing.span('root', route='test'):
+        await asyncio.gather(child(), asyncio.create_task(child()))
+    with pytest.raises(ValueError):
+        with tracing.span('failure'):
+            raise ValueError()
+    *children, root, failure = tracing.EXPORTER.spans
+    assert root['name'] == 'root'
+    assert root['parent_id'] is None
+    assert root['attributes'] == {'route': 'test'}
+    assert len(children) == 2
+    for span in children:
+        assert span['trace_id'] == root['trace_id']
+        assert span['parent_id'] == root['span_id']
+    assert failure['trace_id'] != root['trace_id']
+    assert failure['error'] == 'ValueError()'
@@ -14,6 +14,52 @@ def test_generating_schema(configurations, schemas):
         assert schema == schemas[survey_name]
 
 
+def test_sharing_schemas_of_identical_field_structures(
+        monkeypatch,
+        configurations,
+    ):
+    """Test that schemas are shared unless the validation rules differ."""
+    validator = validation.SubmissionValidator
+    generate = validator._generate_validation_schema
+    generated = []
+
+    def _generate(configuration):
+        """Record the configurations that schemas are generated for."""
+        generated.append(configuration)
+        return generate(configuration)
+
+    monkeypatch.setattr(validation, 'SCHEMAS', {})
+    monkeypatch.setattr(validator, '_generate_validation_schema', _generate)
+    configuration = copy.deepcopy(configurations['complex-survey'])
+    first = validator.create(configuration)
+    configuration['fields'][0]['title'] = 'What is your email?'
+    configuration['fields'][2]['fields'][0]['description'] = 'Green'
+    second = validator.create(configuration)
+    assert len(generated) == 1
+    assert second is not first
+    assert second.schema is first.schema
+    configuration['fields'][1]['required'] = False
+    validator.create(configuration)
+    assert len(generated) == 2
+
+
+def test_validating_with_validators_of_the_same_fields(
+        configurations,
+        submissionss,
+    ):
+    """Test that validations do not leak into other surveys' validators."""
+    configuration = configurations['option']
+    invalid = submissionss['option']['invalid'][0]
+    valid = submissionss['option']['valid'][0]
+    validator = validation.SubmissionValidator.create(configuration)
+    assert not validator.validate(invalid)
+    other = validation.SubmissionValidator.create(configuration)
+    assert other is not validator
+    assert other.errors == {}
+    assert other.validate(valid)
+    assert not validator.validate(invalid)
+
+
 @pytest.fixture(scope='module')
 def validator(configurations):
     """Provide generic validator for configuration-independent rule testing."""